@@ -0,0 +1,93 @@
+import gzip
+import logging
+import mimetypes
+import os
+from hashlib import sha256
+from typing import Dict
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOG = logging.getLogger("assets")
+# Assets requested by their content hash URL never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Pages and assets requested by their plain name may change upon restart, clients revalidate them via ETag
+REVALIDATE = "no-cache"
+
+
+def accepted_encodings(request: Request) -> set:
+    encodings = set()
+    for token in request.headers.get("accept-encoding", "").split(","):
+        encoding, _, params = token.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0"):
+            encodings.add(encoding.strip().lower())
+    return encodings
+
+
+class Asset:
+    """Body of a static file or page with its compressed variants, prepared once and served from memory"""
+
+    def __init__(self, body: bytes, media_type: str):
+        self.media_type = media_type
+        self.digest = sha256(body).hexdigest()
+        self.etag = f'"{self.digest[:16]}"'
+        # Compressed variants are only kept if they are actually smaller
+        self.variants: Dict[str, bytes] = {}
+        if brotli is not None:
+            self.__add_variant("br", brotli.compress(body, quality=11), body)
+        self.__add_variant("gzip", gzip.compress(body, 9, mtime=0), body)
+        self.body = body
+
+    def __add_variant(self, encoding: str, compressed: bytes, body: bytes):
+        if len(compressed) < len(body):
+            self.variants[encoding] = compressed
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        headers = {"Cache-Control": cache_control, "ETag": self.etag, "Vary": "Accept-Encoding"}
+        if self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        accepted = accepted_encodings(request)
+        for encoding, body in self.variants.items():
+            if encoding in accepted:
+                headers["Content-Encoding"] = encoding
+                return Response(body, headers=headers, media_type=self.media_type)
+        return Response(self.body, headers=headers, media_type=self.media_type)
+
+
+class StaticAssets:
+    """Files of a directory, served by their plain name and by a URL with their content hash (e.g. control.3f2a.js)"""
+
+    def __init__(self, directory: str):
+        # Content hash URL (relative to the page) by file name, for the page template
+        self.urls: Dict[str, str] = {}
+        self.assets: Dict[str, Asset] = {}
+        self.hashed: Dict[str, Asset] = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as file:
+                body = file.read()
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if media_type.startswith("text/") or media_type.endswith("javascript"):
+                media_type += "; charset=utf-8"
+            asset = Asset(body, media_type)
+            stem, extension = os.path.splitext(name)
+            hashed_name = f"{stem}.{asset.digest[:12]}{extension}"
+            self.assets[name] = asset
+            self.hashed[hashed_name] = asset
+            self.urls[name] = f"{os.path.basename(directory)}/{hashed_name}"
+        LOG.info("Prepared %d static assets (%s)", len(self.assets),
+                 "gzip, brotli" if brotli is not None else "gzip")
+
+    def response(self, name: str, request: Request) -> Response:
+        if name in self.hashed:
+            return self.hashed[name].response(request, IMMUTABLE)
+        if name in self.assets:
+            return self.assets[name].response(request, REVALIDATE)
+        return Response(status_code=404)
@@ -0,0 +1,218 @@
+"""Offline benchmarks of ptzctrl against simulated cameras, a simulated tally bridge and a swarm of tablets.
+
+Run from the repository root (uvicorn and websockets are required): python -m bench --help
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+from time import perf_counter
+from typing import List
+
+import constants
+from bench.camera import SimulatedCamera, start_camera
+from bench.swarm import connect_swarm, close_swarm
+from bench.tally import SimulatedTallyServer
+
+
+def report(name: str, samples: List[float]):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name:<48} n={len(samples):<5} p50={statistics.median(samples) * 1000:8.2f} ms "
+          f"p95={p95 * 1000:8.2f} ms  max={samples[-1] * 1000:8.2f} ms")
+
+
+def configure(args, db_dir: str):
+    """Point the application to the simulated environment, must be called before main is imported"""
+
+    constants.NUM_CAMERAS = args.cameras
+    constants.CAMERA_IPS = [f"127.0.0.{cam + 2}" for cam in range(args.cameras)]
+    constants.VISCA_UDP_PORT = args.visca_port
+    constants.RELAY_UDP_PORT = args.relay_port
+    constants.RELAY_CAMERA_PORTS = []
+    constants.TALLY_IDS = [cam + 1 for cam in range(args.cameras)]
+    constants.TALLY_SOURCES = [("127.0.0.1", args.tally_port)]
+    constants.DB_FILE = os.path.join(db_dir, "db.sqlite")
+    # Polls of the camera state would be counted as requests of the recalls
+    constants.MIRROR_POLL_INTERVAL = 0
+
+
+async def bench_recall(args, url: str, camera: SimulatedCamera):
+    tablets = await connect_swarm(url, 1)
+    tablet = tablets[0]
+    loop = asyncio.get_running_loop()
+    focus_applied = None
+
+    def on_receive(data: bytes):
+        # Focus direct is the last step of a recall
+        if data[1] == 0x01 and data[2] == 0x04 and data[3] == 0x48 and not focus_applied.done():
+            focus_applied.set_result(loop.time())
+
+    positions = 4
+    for pos in range(positions):
+        await tablet.send("save_pos", {"cam": 0, "pos": pos})
+    await asyncio.sleep(0.5)
+    camera.on_receive = on_receive
+    samples = []
+    requests = 0
+    round_trips = 0
+    for i in range(args.recalls):
+        focus_applied = loop.create_future()
+        first = len(camera.received)
+        start = loop.time()
+        await tablet.send("recall_pos", {"cam": 0, "pos": i % positions})
+        samples.append(await asyncio.wait_for(focus_applied, constants.RECALL_TIMEOUT) - start)
+        # Let the camera complete the focus command
+        await asyncio.sleep(args.camera_delay * 2)
+        arrivals = [arrival for arrival, _data in camera.received[first:]]
+        requests += len(arrivals)
+        # Requests sent without waiting for an answer in between arrive together, within one round trip
+        round_trips += 1 + sum(1 for a, b in zip(arrivals, arrivals[1:]) if b - a > 0.001)
+    camera.on_receive = None
+    report("Recall (press => focus applied at camera)", samples)
+    print(f"{'Recall VISCA requests/round trips':<48} {requests / args.recalls:.1f} requests, "
+          f"{round_trips / args.recalls:.1f} round trips per recall")
+    await close_swarm(tablets)
+
+
+def bench_recall_compile(args):
+    from visca import CommandSocket, RecallMacro
+
+    camera = CommandSocket("127.0.0.1", args.visca_port)
+    start = perf_counter()
+    for i in range(args.recalls * 100):
+        RecallMacro(i % 128, i % 1771)
+    compiled = (perf_counter() - start) / (args.recalls * 100)
+    start = perf_counter()
+    for i in range(args.recalls * 100):
+        camera.compile_recall(i % 16, 1000)
+    cached = (perf_counter() - start) / (args.recalls * 100)
+    print(f"{'Recall command bytes (compiled/cached)':<48} {compiled * 1e6:8.2f} us compiled, "
+          f"{cached * 1e6:8.2f} us cached")
+
+
+async def bench_fanout(args, url: str):
+    for size in args.clients:
+        tablets = await connect_swarm(url, size)
+        start = perf_counter()
+        for i in range(args.events):
+            await tablets[0].send("allow_on_air_change", i % 2 == 0)
+        await asyncio.gather(*[tablet.wait_for("update_on_air_change", args.events) for tablet in tablets])
+        elapsed = perf_counter() - start
+        print(f"{f'Fan-out to {size} clients':<48} {args.events} events in {elapsed * 1000:8.2f} ms, "
+              f"{size * args.events / elapsed:10.0f} messages/s")
+        await close_swarm(tablets)
+
+
+async def bench_tally(args, url: str, tally_server: SimulatedTallyServer):
+    tablets = await connect_swarm(url, max(args.clients))
+    samples = []
+    for i in range(args.tally_changes):
+        count = tablets[0].counts["update_tally"] + 1
+        start = perf_counter()
+        # Cut between the first two cameras, changing two tally IDs at once
+        tally_server.set_states({1: 2 if i % 2 == 0 else 1, 2: 1 if i % 2 == 0 else 2})
+        await asyncio.gather(*[tablet.wait_for("update_tally", count) for tablet in tablets])
+        samples.append(perf_counter() - start)
+    report(f"Tally change => {len(tablets)} clients updated", samples)
+    await close_swarm(tablets)
+
+
+class RelayClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = 0
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        self.replies += 1
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+async def bench_relay(args, tally_server: SimulatedTallyServer):
+    loop = asyncio.get_running_loop()
+    # Preview on the first camera selects it as relay target
+    tally_server.set_states({1: 1, 2: 0})
+    await asyncio.sleep(0.2)
+    transport, client = await loop.create_datagram_endpoint(RelayClient,
+                                                            remote_addr=("127.0.0.1", args.relay_port))
+    inquiry = bytes([0x81, 0x09, 0x04, 0x00, 0xFF])
+    samples = []
+    for _ in range(args.packets // 10):
+        client.waiter = loop.create_future()
+        start = perf_counter()
+        transport.sendto(inquiry)
+        await asyncio.wait_for(client.waiter, 1.0)
+        samples.append(perf_counter() - start)
+    report("Relay round trip (inquiry)", samples)
+    # Throughput with a window of outstanding inquiries
+    client.replies = 0
+    window = 16
+    start = perf_counter()
+    for sent in range(args.packets):
+        while sent - client.replies >= window:
+            client.waiter = loop.create_future()
+            await asyncio.wait_for(client.waiter, 1.0)
+        transport.sendto(inquiry)
+    while client.replies < args.packets:
+        client.waiter = loop.create_future()
+        await asyncio.wait_for(client.waiter, 1.0)
+    elapsed = perf_counter() - start
+    print(f"{'Relay throughput':<48} {args.packets} packets in {elapsed * 1000:8.2f} ms, "
+          f"{args.packets / elapsed:10.0f} packets/s")
+    transport.close()
+
+
+async def run(args):
+    import uvicorn
+
+    cameras = [await start_camera(ip, args.visca_port, delay=args.camera_delay, loss=args.loss)
+               for ip in constants.CAMERA_IPS]
+    tally_server = SimulatedTallyServer()
+    await tally_server.start("127.0.0.1", args.tally_port)
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.http_port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    url = f"ws://127.0.0.1:{args.http_port}/ws"
+    try:
+        bench_recall_compile(args)
+        await bench_recall(args, url, cameras[0])
+        await bench_fanout(args, url)
+        await bench_tally(args, url, tally_server)
+        await bench_relay(args, tally_server)
+    finally:
+        server.should_exit = True
+        await server_task
+        tally_server.close()
+        for camera in cameras:
+            camera.transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cameras", type=int, default=3, help="number of simulated cameras (at least 2)")
+    parser.add_argument("--camera-delay", type=float, default=0.005, help="seconds until a command completes")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of a lost camera reply")
+    parser.add_argument("--clients", type=lambda s: [int(c) for c in s.split(",")], default=[1, 10, 50],
+                        help="comma separated numbers of simulated tablets for the fan-out benchmark")
+    parser.add_argument("--recalls", type=int, default=50)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--tally-changes", type=int, default=50)
+    parser.add_argument("--packets", type=int, default=2000)
+    parser.add_argument("--http-port", type=int, default=18000)
+    parser.add_argument("--visca-port", type=int, default=11259)
+    parser.add_argument("--relay-port", type=int, default=11260)
+    parser.add_argument("--tally-port", type=int, default=17411)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as db_dir:
+        configure(args, db_dir)
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
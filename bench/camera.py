@@ -0,0 +1,104 @@
+import asyncio
+import random
+from typing import Callable, List, Optional, Tuple
+
+
+class SimulatedCamera(asyncio.DatagramProtocol):
+    """VISCA camera speaking the commands used by visca.CommandSocket, with two command buffers.
+
+    Commands are acknowledged right away and completed after `delay` seconds, inquiries are answered after
+    `inquiry_delay` seconds. Each reply is lost with probability `loss`.
+    """
+
+    def __init__(self, delay=0.005, inquiry_delay=0.002, loss=0.0):
+        self.delay = delay
+        self.inquiry_delay = inquiry_delay
+        self.loss = loss
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.sockets = [False, False]
+        self.power = 2
+        self.focus = 0x200
+        self.af_mode = 3
+        self.zoom = 0
+        self.pan = 0
+        self.tilt = 0
+        self.memory = {}
+        # Received commands with their arrival time
+        self.received: List[Tuple[float, bytes]] = []
+        # Optional observer of received commands
+        self.on_receive: Optional[Callable[[bytes], None]] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def reply(self, data: List[int], addr, delay=0.0):
+        if self.loss and random.random() < self.loss:
+            return
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, bytes(data), addr)
+        else:
+            self.transport.sendto(bytes(data), addr)
+
+    def datagram_received(self, data, addr):
+        self.received.append((asyncio.get_running_loop().time(), data))
+        if self.on_receive is not None:
+            self.on_receive(data)
+        if data[1] == 0x09:
+            self.reply(self.answer_inquiry(data), addr, self.inquiry_delay)
+            return
+        if False not in self.sockets:
+            self.reply([0x90, 0x60, 0x03, 0xFF], addr)
+            return
+        socket = self.sockets.index(False)
+        self.sockets[socket] = True
+        self.reply([0x90, 0x41 + socket, 0xFF], addr)
+        asyncio.get_running_loop().call_later(self.delay, self.complete, data, socket, addr)
+
+    def complete(self, data: bytes, socket: int, addr):
+        self.sockets[socket] = False
+        self.execute(data)
+        self.reply([0x90, 0x51 + socket, 0xFF], addr)
+
+    def execute(self, data: bytes):
+        category, command = data[2], data[3]
+        if category == 0x04 and command == 0x00:
+            self.power = data[4]
+        elif category == 0x04 and command == 0x48:
+            self.focus = (data[4] << 12) | (data[5] << 8) | (data[6] << 4) | data[7]
+        elif category == 0x04 and command == 0x38:
+            self.af_mode = data[4]
+        elif category == 0x04 and command == 0x68:
+            # Focus lock
+            self.af_mode = 3 if data[4] == 2 else 2
+        elif category == 0x04 and command == 0x3F:
+            if data[4] == 0x01:
+                self.memory[data[5]] = (self.pan, self.tilt, self.zoom)
+            elif data[4] == 0x02 and data[5] in self.memory:
+                self.pan, self.tilt, self.zoom = self.memory[data[5]]
+
+    @staticmethod
+    def half_bytes(value: int, count=4) -> List[int]:
+        return [(value >> (4 * i)) & 0x0F for i in reversed(range(count))]
+
+    def answer_inquiry(self, data: bytes) -> List[int]:
+        category, command = data[2], data[3]
+        if category == 0x04 and command == 0x00:
+            return [0x90, 0x50, self.power, 0xFF]
+        elif category == 0x04 and command == 0x38:
+            return [0x90, 0x50, self.af_mode, 0xFF]
+        elif category == 0x04 and command == 0x48:
+            return [0x90, 0x50] + self.half_bytes(self.focus) + [0xFF]
+        elif category == 0x04 and command == 0x47:
+            return [0x90, 0x50] + self.half_bytes(self.zoom) + [0xFF]
+        elif category == 0x06 and command == 0x12:
+            return [0x90, 0x50] + self.half_bytes(self.pan) + self.half_bytes(self.tilt, 4) + [0xFF]
+        # Command not executable
+        return [0x90, 0x60, 0x41, 0xFF]
+
+
+async def start_camera(ip: str, port: int, **kwargs) -> SimulatedCamera:
+    _transport, camera = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: SimulatedCamera(**kwargs),
+        local_addr=(ip, port)
+    )
+    return camera
@@ -0,0 +1,53 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+
+class SimulatedTablet:
+    """WebSocket client counting the events it receives"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.websocket = None
+        self.init: Optional[dict] = None
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.last: Dict[str, Any] = {}
+        self.changed = asyncio.Event()
+        self.reader: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.url, max_queue=None)
+        self.init = json.loads(await self.websocket.recv())
+        self.reader = asyncio.create_task(self.__read())
+
+    async def __read(self):
+        async for raw in self.websocket:
+            message = json.loads(raw)
+            self.counts[message["event"]] += 1
+            self.last[message["event"]] = message["data"]
+            self.changed.set()
+
+    async def wait_for(self, event: str, count: int):
+        while self.counts[event] < count:
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def send(self, event: str, data: Any):
+        await self.websocket.send(json.dumps({"event": event, "data": data}))
+
+    async def close(self):
+        self.reader.cancel()
+        await self.websocket.close()
+
+
+async def connect_swarm(url: str, size: int) -> List[SimulatedTablet]:
+    tablets = [SimulatedTablet(url) for _ in range(size)]
+    await asyncio.gather(*[tablet.connect() for tablet in tablets])
+    return tablets
+
+
+async def close_swarm(tablets: List[SimulatedTablet]):
+    await asyncio.gather(*[tablet.close() for tablet in tablets])
@@ -0,0 +1,49 @@
+import asyncio
+from asyncio import StreamReader, StreamWriter
+from typing import Dict, List, Optional
+
+
+class SimulatedTallyServer:
+    """Stand-in for the tally bridge, speaking the protocol of tally.connect/tally.watch.
+
+    Clients register with 0xFF, the number of tally IDs and the IDs, and then receive (tally ID, state) pairs.
+    Keep-alive messages (0xFF 0xFF) are echoed.
+    """
+
+    def __init__(self):
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[StreamWriter, List[int]] = {}
+        self.states: Dict[int, int] = {}
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.__handle, host, port)
+
+    def close(self):
+        for writer in self.clients:
+            writer.close()
+        self.server.close()
+
+    async def __handle(self, reader: StreamReader, writer: StreamWriter):
+        try:
+            header = await reader.readexactly(2)
+            tally_ids = list(await reader.readexactly(header[1]))
+            self.clients[writer] = tally_ids
+            # Send current states to the new client
+            writer.write(b"".join(bytes((tally_id, self.states.get(tally_id, 0))) for tally_id in tally_ids))
+            while True:
+                message = await reader.readexactly(2)
+                if message == b"\xff\xff":
+                    writer.write(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def set_states(self, states: Dict[int, int]):
+        """Change the states of several tally IDs at once, like a transition on the video mixer"""
+
+        self.states.update(states)
+        for writer, tally_ids in self.clients.items():
+            writer.write(b"".join(bytes((tally_id, state)) for tally_id, state in states.items()
+                                  if tally_id in tally_ids))
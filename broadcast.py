@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Any, Union, Deque, Tuple, Optional
+
+from starlette.websockets import WebSocket
+
+from constants import BROADCAST_QUEUE_SIZE, BROADCAST_SLOW_CLIENT_POLICY, EVENT_LOG_SIZE
+from protocol import encode_json, encode_binary
+
+LOG = logging.getLogger("broadcast")
+
+
+class Client:
+    """Connected WebSocket client, frames are sent by its own writer task from a bounded queue"""
+
+    def __init__(self, websocket: WebSocket, binary: bool):
+        self.websocket = websocket
+        # Whether the client accepts binary frames
+        self.binary = binary
+        self.queue: asyncio.Queue = asyncio.Queue(BROADCAST_QUEUE_SIZE)
+        self.writer = asyncio.create_task(self.__write())
+
+    def __str__(self):
+        return f"{self.websocket.client.host}:{self.websocket.client.port}"
+
+    async def __write(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            LOG.warning("Sending to websocket client %s failed, disconnecting", self, exc_info=e)
+            await self.close()
+
+    def enqueue(self, frame: Union[str, bytes]):
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            if BROADCAST_SLOW_CLIENT_POLICY == "drop":
+                LOG.warning("Send queue of websocket client %s is full, frame dropped", self)
+            else:
+                LOG.warning("Send queue of websocket client %s is full, disconnecting", self)
+                self.writer.cancel()
+                asyncio.create_task(self.close())
+
+    async def close(self):
+        try:
+            # 1013: Try again later, the client will reconnect and receive a fresh state
+            await self.websocket.close(1013)
+        except Exception as e:
+            LOG.debug("Closing websocket client %s failed: %s", self, e)
+
+
+class Broadcaster:
+    """Fan-out of events to all clients, encoding each event only once and never waiting on a client socket.
+
+    Every published event is a state change and numbered by a sequence number (assigned by the coordinator), so
+    clients can detect missed events. The most recent events are kept, so reconnecting clients only need to receive
+    the events they missed. Sequence numbers are only valid within the same epoch, i.e. until the coordinator is
+    restarted.
+    """
+
+    def __init__(self):
+        self.clients: Dict[WebSocket, Client] = {}
+        self.seq = 0
+        self.epoch: Optional[int] = None
+        # Sequence number, JSON frame and binary frame (if available) of the latest events
+        self.log: Deque[Tuple[int, str, Optional[bytes]]] = deque(maxlen=EVENT_LOG_SIZE)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add(self, websocket: WebSocket, binary=False):
+        self.clients[websocket] = Client(websocket, binary)
+
+    async def remove(self, websocket: WebSocket):
+        client = self.clients.pop(websocket)
+        client.writer.cancel()
+        try:
+            await client.writer
+        except asyncio.CancelledError:
+            pass
+
+    def send(self, websocket: WebSocket, event: str, data: Any):
+        """Send an event to a single client (if still connected), tagged with the current sequence number"""
+
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.enqueue(encode_json(event, self.seq, data))
+
+    def publish(self, seq: int, event: str, data: Any):
+        self.seq = seq
+        frame = encode_json(event, seq, data)
+        binary_frame = encode_binary(event, seq, data)
+        self.log.append((seq, frame, binary_frame))
+        for client in self.clients.values():
+            client.enqueue(binary_frame if client.binary and binary_frame is not None else frame)
+
+    def reset(self, epoch: int, seq: int) -> bool:
+        """Continue with the events of the given epoch, returns True if the clients need a fresh state"""
+
+        if epoch == self.epoch and seq == self.seq:
+            return False
+        self.epoch = epoch
+        self.seq = seq
+        self.log.clear()
+        return True
+
+    def init(self, websocket: WebSocket, seq: int, state: dict):
+        """Send the complete state to a client, followed by the state changes published since it was taken"""
+
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        client.enqueue(encode_json("init", seq, state))
+        for logged_seq, frame, binary_frame in self.log:
+            if logged_seq > seq:
+                client.enqueue(binary_frame if client.binary and binary_frame is not None else frame)
+
+    def resume(self, websocket: WebSocket, epoch: int, since: int) -> bool:
+        """Send the events a reconnecting client missed since the given sequence number.
+
+        Returns False if these events are not available anymore, the client needs the full state then.
+        """
+
+        missed = self.seq - since
+        if epoch != self.epoch or missed < 0 or missed >= BROADCAST_QUEUE_SIZE:
+            return False
+        if missed > 0 and (not self.log or self.log[0][0] > since + 1):
+            return False
+        client = self.clients[websocket]
+        client.enqueue(encode_json("resume", since, None))
+        for seq, frame, binary_frame in self.log:
+            if seq > since:
+                client.enqueue(binary_frame if client.binary and binary_frame is not None else frame)
+        LOG.debug("Websocket client %s resumed with %d missed events", client, missed)
+        return True
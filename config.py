@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional
+
+from constants import CAMERA_IPS, NUM_CAMERAS, NUM_BUTTONS, TALLY_IDS, SCENE_MEMORY_OFFSET, CONFIG_FILE, \
+    CONFIG_POLL_INTERVAL
+
+LOG = logging.getLogger("config")
+
+
+class Config:
+    """Cameras, buttons and tally IDs, as in constants.py unless overridden by CONFIG_FILE (JSON object with the
+    same names as keys, e.g. {"CAMERA_IPS": [...], "NUM_BUTTONS": 12})"""
+
+    def __init__(self, camera_ips: List[str], num_cameras: int, num_buttons: int, tally_ids: List[int]):
+        if not 0 <= num_cameras <= len(camera_ips):
+            raise ValueError(f"NUM_CAMERAS must be between 0 and the number of CAMERA_IPS ({len(camera_ips)})")
+        if not 0 < num_buttons <= SCENE_MEMORY_OFFSET:
+            raise ValueError(f"NUM_BUTTONS must be between 1 and SCENE_MEMORY_OFFSET ({SCENE_MEMORY_OFFSET})")
+        if len(tally_ids) > len(camera_ips):
+            raise ValueError("TALLY_IDS must not contain more IDs than CAMERA_IPS")
+        self.camera_ips = list(camera_ips)
+        self.num_cameras = num_cameras
+        self.num_buttons = num_buttons
+        self.tally_ids = list(tally_ids)
+
+    def __eq__(self, other):
+        return isinstance(other, Config) and vars(self) == vars(other)
+
+    @staticmethod
+    def load() -> "Config":
+        values = {"CAMERA_IPS": CAMERA_IPS, "NUM_CAMERAS": NUM_CAMERAS, "NUM_BUTTONS": NUM_BUTTONS,
+                  "TALLY_IDS": TALLY_IDS}
+        if CONFIG_FILE and os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE) as file:
+                overrides = json.load(file)
+            unknown = set(overrides) - set(values)
+            if unknown:
+                raise ValueError(f"Unknown settings {', '.join(sorted(unknown))}")
+            values.update(overrides)
+        return Config(values["CAMERA_IPS"], values["NUM_CAMERAS"], values["NUM_BUTTONS"], values["TALLY_IDS"])
+
+
+class ConfigWatcher:
+    """Checks CONFIG_FILE for changes and passes on the new configuration, invalid ones are logged and ignored"""
+
+    def __init__(self, config: Config, apply: Callable[[Config], Awaitable[None]]):
+        self.config = config
+        self.apply = apply
+        self.mtime = self.__mtime()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if CONFIG_FILE:
+            self.task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    def __mtime() -> Optional[float]:
+        try:
+            return os.stat(CONFIG_FILE).st_mtime if CONFIG_FILE else None
+        except OSError:
+            return None
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(CONFIG_POLL_INTERVAL)
+            mtime = self.__mtime()
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                config = Config.load()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                LOG.error("Configuration in %s not applied: %s", CONFIG_FILE, e)
+                continue
+            if config == self.config:
+                continue
+            LOG.info("Applying changed configuration from %s", CONFIG_FILE)
+            try:
+                await self.apply(config)
+            except Exception as e:
+                LOG.error("Error whilst applying configuration", exc_info=e)
+            self.config = config
@@ -4,21 +4,92 @@ WEB_TITLE = "MEINE KIRCHE Regensburg | PTZ Control"
 # Provide only the number of cameras with actual PTZ capabilities and a sensible number of buttons
 NUM_CAMERAS = 3
 NUM_BUTTONS = 18
+# Number of scenes, each saving the positions of all PTZ cameras at once
+NUM_SCENES = 6
+# Camera memory slot of the first scene, scenes use the slots from here on (up to 127 in total)
+# Must not overlap with the slots of the buttons (0 to NUM_BUTTONS - 1)
+SCENE_MEMORY_OFFSET = 100
 # You may add additional cameras here, which will only receive global focus/power commands
 # However, you MUST put the "real" PTZ cameras first!
 CAMERA_IPS = ['10.1.0.31', '10.1.0.32', '10.1.0.33']
 VISCA_UDP_PORT = 1259
+# UDP port for external VISCA controllers, relayed to the camera selected by tally state
+RELAY_UDP_PORT = 1259
+# Optional additional UDP ports, each relaying to a fixed camera in the order of CAMERA_IPS, e.g. [1260, 1261, 1262]
+RELAY_CAMERA_PORTS = []
+# Seconds after which an idle relay session (controller => camera) is closed
+RELAY_SESSION_TIMEOUT = 60.0
+# Minimum interval (in seconds) between pan-tilt/zoom drive commands relayed to a camera, the latest command wins
+# Stop and other commands are always relayed immediately, 0 disables rate limiting
+RELAY_DRIVE_INTERVAL = 0.05
+# Set to True if controllers and cameras speak VISCA over IP (with 8-byte header including sequence numbers)
+RELAY_VISCA_OVER_IP = False
 VISCA_MEMORY_SPEED = 0x18
+# Number of command buffers (sockets) of the cameras, i.e. the number of commands executed concurrently
+VISCA_COMMAND_BUFFERS = 2
 # The order of these IDs must match the order of CAMERA_IPS w.r.t. your ATEM controller
 # Leave empty to disable on air change protection
 TALLY_IDS = [1, 2, 3]
-TALLY_HOST = "pi.mk"
-TALLY_PORT = 7411
-# Frequency used for doing a ping-pong to check if tally connection is alive
-TALLY_KEEPALIVE_FREQUENCY = 10.0
+# Tally sources (host, port), connections are raced and a standby connection is kept for instant failover
+TALLY_SOURCES = [("pi.mk", 7411)]
+# Interval (in seconds) between keep-alive pings to the tally source
+TALLY_KEEPALIVE_FREQUENCY = 1.0
+# Time (in seconds) without any data (including keep-alive answers) after which a tally connection is considered dead
+TALLY_KEEPALIVE_TIMEOUT = 2.0
+# Timeout (in seconds) for establishing a tally connection
+TALLY_CONNECT_TIMEOUT = 2.0
+# Maximum delay (in seconds) between reconnection attempts if no tally source is reachable
+TALLY_RECONNECT_MAX_DELAY = 2.0
+# Unix socket of the coordinator process (python coordinator.py) owning cameras, tally and relay, e.g.
+# "/tmp/ptzctrl.sock", allows for multiple web workers (uvicorn --workers N)
+# None runs the coordinator within the single web worker process
+COORDINATOR_SOCKET = None
 # The place where to expect/create the SQLite database for button data
 DB_FILE = "db/db.sqlite"
+# Interval (in seconds) for writing changed button data to the database in the background
+DB_FLUSH_INTERVAL = 2.0
 # Timeout for most camera operations
 VISCA_TIMEOUT = 5.0
 # Timeout for recall operations
 RECALL_TIMEOUT = 20.0
+# Interval (in seconds) between health probes of the cameras (power inquiry)
+HEALTH_PROBE_INTERVAL = 2.0
+# Timeout (in seconds) for a health probe, a camera answers an inquiry within few milliseconds
+HEALTH_PROBE_TIMEOUT = 0.5
+# Number of consecutive failures after which a camera is considered down, commands to it fail immediately
+HEALTH_DOWN_THRESHOLD = 2
+# Maximum number of messages waiting to be sent to a single client
+BROADCAST_QUEUE_SIZE = 64
+# What to do with a client that does not keep up with its messages: "disconnect" (it will reconnect) or "drop"
+BROADCAST_SLOW_CLIENT_POLICY = "disconnect"
+# Number of recent state changes kept for clients that reconnect
+EVENT_LOG_SIZE = 48
+# Log level, and levels of single modules (logger names) overriding it, e.g. {"visca": "DEBUG", "relay": "DEBUG"}
+LOG_LEVEL = "INFO"
+LOG_LEVELS = {}
+# Number of times the same message may be logged per interval (in seconds), further ones are suppressed and counted
+# Warnings, errors and state changes (tally, relay) are never suppressed, 0 disables rate limiting
+LOG_RATE_LIMIT = 10
+LOG_RATE_INTERVAL = 10.0
+# File recording tally changes, relay switches, VISCA packets and client requests for post-mortems (see replay.py)
+# None disables the journal
+JOURNAL_FILE = None
+# Interval (in seconds) between writes of the journal, and buffered bytes that trigger an earlier write
+JOURNAL_FLUSH_INTERVAL = 1.0
+JOURNAL_BUFFER_SIZE = 1 << 16
+# Buffered bytes beyond which records are dropped, if writing the journal falls behind
+JOURNAL_BUFFER_LIMIT = 1 << 22
+# Interval (in seconds) between polls of position, focus and AF mode of each PTZ camera, 0 disables polling
+MIRROR_POLL_INTERVAL = 1.0
+# Poll intervals while a camera is moving, and while it is on air (to keep traffic to it low)
+MIRROR_POLL_INTERVAL_MOVING = 0.1
+MIRROR_POLL_INTERVAL_ON_AIR = 5.0
+# Timeout (in seconds) for a poll
+MIRROR_POLL_TIMEOUT = 0.5
+# Time (in seconds) a camera is considered moving after a recall or relayed command, even if its position is unchanged
+MIRROR_ACTIVITY_TIME = 1.0
+# JSON file overriding CAMERA_IPS, NUM_CAMERAS, NUM_BUTTONS and TALLY_IDS, e.g. {"NUM_BUTTONS": 12}
+# Changes to the file are applied without restart, None disables it
+CONFIG_FILE = None
+# Interval (in seconds) between checks of CONFIG_FILE for changes
+CONFIG_POLL_INTERVAL = 2.0
@@ -0,0 +1,426 @@
+import asyncio
+import json
+import logging
+from asyncio.exceptions import TimeoutError
+from functools import partial
+from time import time
+from typing import Optional, List, Callable, Awaitable, Dict, Any, Tuple
+
+from config import Config, ConfigWatcher
+from constants import VISCA_UDP_PORT, VISCA_TIMEOUT, RECALL_TIMEOUT, SCENE_MEMORY_OFFSET, NUM_SCENES, JOURNAL_FILE
+from db import Database
+from health import HealthMonitor, Health, CameraUnavailableException
+from journal import JOURNAL, Kind, NO_CAMERA
+from logs import setup_logging, NO_RATE_LIMIT
+from mirror import StateMirror
+from metrics import CAMERA_HEALTH
+from protocol import VERSION as PROTOCOL_VERSION
+from relay import run_relay, Relay
+from scheduler import CameraScheduler, Priority
+from tally import watch_tallies, stop_watcher
+from visca import CommandSocket, State, AnswerException
+
+LOG = logging.getLogger("coordinator")
+# Client requests handled by the coordinator
+EVENTS = frozenset({"update_button", "save_pos", "recall_pos", "save_scene", "recall_scene", "focus_lock", "power",
+                    "allow_on_air_change", "clear_all", "reconnect"})
+
+
+def log_job_failure(job: asyncio.Future):
+    if job.cancelled() or job.exception() is None:
+        return
+    if isinstance(job.exception(), CameraUnavailableException):
+        LOG.warning("Camera job skipped: %s", job.exception())
+    else:
+        LOG.warning("Camera job failed", exc_info=job.exception())
+
+
+class Coordinator:
+    """Owns camera sockets, tally watcher and relay as well as the state shared by all clients.
+
+    Exactly one coordinator may run, it is driven by web workers either in-process or via IPC (see ipc.py).
+    Every state change is published to all subscribers with a sequence number, valid within the epoch.
+    """
+
+    def __init__(self):
+        self.config = Config.load()
+        self.config_watcher: Optional[ConfigWatcher] = None
+        self.cameras: List[CommandSocket] = []
+        self.schedulers: List[CameraScheduler] = []
+        self.health: Optional[HealthMonitor] = None
+        self.mirror: Optional[StateMirror] = None
+        self.db: Optional[Database] = None
+        self.relay: Optional[Relay] = None
+        self.tally_states = [0] * len(self.config.tally_ids)
+        self.tally_stale = False
+        self.ip_holder: List[Optional[str]] = [None]
+        self.on_air_change_allowed = False
+        self.subscribers: List[Callable[[int, str, Any], None]] = []
+        self.seq = 0
+        self.epoch = int(time() * 1000)
+
+    async def start(self):
+        # Start recording the journal
+        if JOURNAL_FILE:
+            JOURNAL.open(JOURNAL_FILE)
+        config = self.config
+        # Init camera controls
+        self.cameras = [CommandSocket(ip, VISCA_UDP_PORT, cam) for cam, ip in enumerate(config.camera_ips)]
+        self.health = HealthMonitor(self.cameras, self.__health_notify)
+        self.schedulers = [CameraScheduler(camera, health) for camera, health in zip(self.cameras, self.health.cameras)]
+        CAMERA_HEALTH.function = lambda: {(health.camera.ip,): list(Health).index(health.state)
+                                          for health in self.health.cameras}
+        # Start camera health probes and polling of the PTZ cameras' state
+        self.health.start()
+        self.mirror = StateMirror(self.cameras[:config.num_cameras], self.health.cameras[:config.num_cameras],
+                                  self.__on_air, self.__camera_state_notify)
+        self.mirror.start()
+        # Open database
+        self.db = Database(config.num_cameras, config.num_buttons)
+        self.db.start()
+        self.__compile_recalls()
+        # Start tally state watcher client
+        watch_tallies(config.tally_ids, self.__tally_notify, self.__tally_stale_notify)
+        # Start VISCA relay
+        self.relay = await run_relay(self.ip_holder, config.camera_ips, self.mirror.touch_ip)
+        # Apply changes of the configuration file from now on
+        self.config_watcher = ConfigWatcher(config, self.reconfigure)
+        self.config_watcher.start()
+
+    async def close(self):
+        if self.config_watcher is not None:
+            await self.config_watcher.close()
+        if self.relay is not None:
+            self.relay.close()
+        # Terminate tally state watcher, health probes and polling
+        await stop_watcher()
+        if self.mirror is not None:
+            await self.mirror.close()
+        if self.health is not None:
+            await self.health.close()
+        # Write pending changes and close database
+        if self.db is not None:
+            await self.db.close()
+        # Stop camera jobs and close camera endpoints
+        for scheduler in self.schedulers:
+            await scheduler.close()
+            scheduler.camera.close()
+        # Write the remaining journal records
+        await JOURNAL.close()
+
+    def subscribe(self, subscriber: Callable[[int, str, Any], None]):
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Callable[[int, str, Any], None]):
+        self.subscribers.remove(subscriber)
+
+    def publish(self, event: str, data: Any):
+        self.seq += 1
+        for subscriber in self.subscribers:
+            subscriber(self.seq, event, data)
+
+    def snapshot(self) -> Tuple[int, dict]:
+        """The complete state with the sequence number of the latest state change it contains"""
+
+        return self.seq, {
+            "version": PROTOCOL_VERSION,
+            "epoch": self.epoch,
+            "camera_ips": self.config.camera_ips,
+            "all_pos": self.db.get_data(),
+            "tally_states": self.tally_states,
+            "scenes": self.db.get_scenes(),
+            "tally_stale": self.tally_stale,
+            "camera_health": [state.value for state in self.health.states().values()],
+            "camera_states": self.mirror.states(),
+            "on_air_change_allowed": self.on_air_change_allowed
+        }
+
+    async def handle(self, event: str, data: Any) -> dict:
+        """Handle a client request, returns its result with status "success", "failure" or "timeout"."""
+
+        if JOURNAL.recording:
+            JOURNAL.record(Kind.REQUEST, payload=json.dumps({"event": event, "data": data}).encode())
+        try:
+            if not await self.__dispatch(event, data):
+                return {"status": "failure", "error": f"Unsupported event {event}"}
+        except TimeoutError as e:
+            LOG.warning("Timeout error during visca operation", exc_info=e)
+            return {"status": "timeout"}
+        except AnswerException as e:
+            LOG.warning("Camera rejected visca operation", exc_info=e)
+            return {"status": "failure", "error": str(e)}
+        except CameraUnavailableException as e:
+            LOG.warning("Camera operation skipped: %s", e)
+            return {"status": "failure", "error": str(e)}
+        except Exception as e:
+            LOG.error("Error handling event %s", event, exc_info=e)
+            return {"status": "failure", "error": str(e)}
+        return {"status": "success"}
+
+    async def reconfigure(self, config: Config):
+        """Apply a changed configuration while running, everything that did not change is kept as it is.
+
+        Camera endpoints (with their jobs, health and mirrored state) remain if the camera keeps its number and IP,
+        the tally connection remains unless the tally IDs changed. Clients receive the changes only.
+        """
+
+        old = self.config
+        self.config = config
+        # Reconcile camera endpoints
+        kept = {(camera.cam, camera.ip): scheduler for camera, scheduler in zip(self.cameras, self.schedulers)}
+        self.cameras = [kept[cam, ip].camera if (cam, ip) in kept else CommandSocket(ip, VISCA_UDP_PORT, cam)
+                        for cam, ip in enumerate(config.camera_ips)]
+        self.health.set_cameras(self.cameras)
+        self.schedulers = [kept.pop((cam, camera.ip), None) or CameraScheduler(camera, health)
+                           for cam, (camera, health) in enumerate(zip(self.cameras, self.health.cameras))]
+        await self.mirror.set_cameras(self.cameras[:config.num_cameras], self.health.cameras[:config.num_cameras])
+        for scheduler in kept.values():
+            await scheduler.close()
+            scheduler.camera.close()
+        # Migrate positions and scenes, new cameras need their recalls
+        added = await self.db.resize(config.num_cameras, config.num_buttons)
+        self.__compile_recalls()
+        # Tally states of cameras with the same tally ID remain valid
+        self.tally_states = [self.tally_states[cam] if cam < len(old.tally_ids) and old.tally_ids[cam] == tally_id
+                             else 0 for cam, tally_id in enumerate(config.tally_ids)]
+        if config.tally_ids != old.tally_ids:
+            await stop_watcher()
+            watch_tallies(config.tally_ids, self.__tally_notify, self.__tally_stale_notify)
+        # Relay to the cameras as they are configured now
+        self.relay.set_camera_ips(config.camera_ips)
+        if self.ip_holder[0] is not None and self.ip_holder[0] not in config.camera_ips:
+            self.ip_holder[0] = None
+            JOURNAL.record(Kind.RELAY, NO_CAMERA)
+        for cam, state in enumerate(self.tally_states):
+            self.__update_relay_ip(cam, state)
+        LOG.info("Configuration applied: %d PTZ cameras with %d buttons, %d cameras in total",
+                 config.num_cameras, config.num_buttons, len(config.camera_ips))
+        self.publish("update_config", {
+            "camera_ips": config.camera_ips,
+            "num_cameras": config.num_cameras,
+            "num_buttons": config.num_buttons,
+            "added": added,
+            "tally_states": self.tally_states,
+            "scenes": self.db.get_scenes()
+        })
+
+    async def __dispatch(self, event: str, data: Any) -> bool:
+        if event == "update_button":
+            await asyncio.wait_for(self.__update_button(data), VISCA_TIMEOUT)
+        elif event == "save_pos":
+            await asyncio.wait_for(self.__save_pos(data), VISCA_TIMEOUT)
+        elif event == "recall_pos":
+            await asyncio.wait_for(self.__recall_pos(data), RECALL_TIMEOUT)
+        elif event == "save_scene":
+            await self.__save_scene(data)
+        elif event == "recall_scene":
+            await self.__recall_scene(data)
+        elif event == "focus_lock":
+            await self.__set_all_cameras("focus_lock", CommandSocket.set_focus_lock, State.ON if data else State.OFF)
+        elif event == "power":
+            await self.__set_all_cameras("power", CommandSocket.set_power, State.ON if data else State.OFF)
+        elif event == "allow_on_air_change":
+            await asyncio.wait_for(self.__update_on_air_change(data), VISCA_TIMEOUT)
+        elif event == "clear_all":
+            self.db.clear_buttons()
+            self.publish("clear_buttons", None)
+        elif event == "reconnect":
+            await stop_watcher()
+            watch_tallies(self.config.tally_ids, self.__tally_notify, self.__tally_stale_notify)
+        else:
+            LOG.error(f"Unsupported event: {event} with data {data}")
+            return False
+        return True
+
+    async def __update_button(self, data: dict):
+        self.db.set_button(**data)
+        LOG.debug("Updating users...")
+        # The sender receives its own update as well, to keep its sequence of state changes complete
+        self.publish("update_button", data)
+
+    async def __current_focus(self, cam: int) -> int:
+        """Focus value of a camera, from its mirrored state if up to date, otherwise inquired"""
+
+        focus = self.mirror.cameras[cam].cached_focus()
+        if focus is None:
+            focus = await self.cameras[cam].inq_focus()
+        return focus
+
+    def __track_move(self, cam: int, job: asyncio.Future):
+        """Poll a camera fast while it moves, and once more when the job moving it is done (e.g. focus applied)"""
+
+        mirror = self.mirror.cameras[cam]
+        mirror.touch()
+        job.add_done_callback(lambda _job: mirror.touch())
+
+    async def __save_pos(self, data: dict):
+        if not (0 <= data["cam"] < self.config.num_cameras and 0 <= data["pos"] < self.config.num_buttons):
+            raise ValueError(f"No button {data['pos']} for camera {data['cam']}")
+        camera = self.cameras[data["cam"]]
+
+        async def save():
+            focus = await self.__current_focus(data["cam"])
+            self.db.set_focus(focus=focus, **data)
+            camera.compile_recall(data["pos"], focus)
+            await camera.memory_set(data["pos"])
+
+        await self.schedulers[data["cam"]].submit(Priority.CONTROL, f"save_pos {data['pos']}", save)
+
+    async def __recall_pos(self, data: dict):
+        camera = self.cameras[data["cam"]]
+        focus = self.db.get_focus(**data)
+        # A subsequent recall pre-empts this one, which completes without error then
+        job = self.schedulers[data["cam"]].submit(Priority.RECALL, "recall", partial(camera.recall, data["pos"], focus),
+                                                  preempt=True, timeout=RECALL_TIMEOUT)
+        self.__track_move(data["cam"], job)
+        await job
+
+    async def __await_camera_jobs(self, jobs: Dict[int, asyncio.Future], timeout: float):
+        """Wait for jobs running concurrently on several cameras, raising if any of them failed or timed out.
+
+        Jobs not done in time are cancelled.
+        """
+
+        if not jobs:
+            return
+        for job in jobs.values():
+            job.add_done_callback(log_job_failure)
+        # Cameras that are down do not delay the others, their jobs fail immediately
+        done, pending = await asyncio.wait(jobs.values(), timeout=timeout)
+        # Jobs still running would block their camera, cancel them
+        for job in pending:
+            job.cancel()
+        failed = [self.cameras[cam].ip for cam, job in jobs.items() if job in done and job.exception() is not None]
+        if failed:
+            raise AnswerException(f"Failed for cameras {', '.join(failed)}")
+        if pending:
+            raise TimeoutError()
+
+    async def __set_all_cameras(self, key: str, command: Callable[[CommandSocket, State], Awaitable[None]],
+                                state: State):
+        jobs = {cam: scheduler.submit(Priority.CONTROL, key, partial(command, scheduler.camera, state))
+                for cam, scheduler in enumerate(self.schedulers)}
+        # Focus and AF mode of the PTZ cameras change, their mirrored state does not apply anymore
+        for mirror in self.mirror.cameras:
+            mirror.invalidate()
+            jobs[mirror.cam].add_done_callback(lambda _job, mirror=mirror: mirror.invalidate())
+        await self.__await_camera_jobs(jobs, VISCA_TIMEOUT)
+
+    @staticmethod
+    def __scene_slot(scene: int) -> int:
+        """Camera memory slot of a scene, other values than the scenes' would overwrite the buttons' slots"""
+
+        if not isinstance(scene, int) or not 0 <= scene < NUM_SCENES:
+            raise ValueError(f"Invalid scene {scene}")
+        return SCENE_MEMORY_OFFSET + scene
+
+    async def __save_scene(self, scene: int):
+        slot = self.__scene_slot(scene)
+
+        async def save(cam: int):
+            camera = self.cameras[cam]
+            focus = await self.__current_focus(cam)
+            self.db.set_scene_focus(scene, cam, focus)
+            camera.compile_recall(slot, focus)
+            await camera.memory_set(slot)
+
+        # All PTZ cameras save concurrently, each within its own schedule
+        await self.__await_camera_jobs({cam: self.schedulers[cam].submit(Priority.CONTROL, f"save_scene {scene}",
+                                                                         partial(save, cam))
+                                        for cam in range(self.config.num_cameras)}, VISCA_TIMEOUT)
+        self.publish("update_scenes", self.db.get_scenes())
+
+    async def __recall_scene(self, scene: int):
+        slot = self.__scene_slot(scene)
+        jobs = {}
+        for cam, focus in self.db.get_scene(scene).items():
+            # Never move a camera on air, unless explicitly allowed
+            if cam < len(self.tally_states) and self.tally_states[cam] & 0x2 and not self.on_air_change_allowed:
+                LOG.info("Scene %d: PTZ %d is on air, not recalled", scene + 1, cam + 1)
+                continue
+            # Submitted in one go, so that all cameras start moving together
+            jobs[cam] = self.schedulers[cam].submit(Priority.RECALL, "recall",
+                                                    partial(self.cameras[cam].recall, slot, focus),
+                                                    preempt=True, timeout=RECALL_TIMEOUT)
+            self.__track_move(cam, jobs[cam])
+        await self.__await_camera_jobs(jobs, RECALL_TIMEOUT)
+
+    def __compile_recalls(self):
+        """Compile the recalls of all saved positions and scenes ahead of time"""
+
+        saved = [(cam, pos, focus) for (cam, pos), focus in self.db.focus.items()]
+        saved += [(cam, SCENE_MEMORY_OFFSET + scene, focus) for (scene, cam), focus in self.db.scenes.items()]
+        for cam, pos, focus in saved:
+            if focus != -1:
+                try:
+                    self.cameras[cam].compile_recall(pos, focus)
+                except Exception as e:
+                    LOG.warning("Cannot compile recall of position %d for PTZ %d: %s", pos, cam + 1, e)
+
+    async def __update_on_air_change(self, allow: bool):
+        self.on_air_change_allowed = bool(allow)
+        # Update relay state if there is a camera that is selected for preview and program
+        for cam, state in enumerate(self.tally_states):
+            if state == 3:
+                self.__update_relay_ip(cam, state)
+        LOG.debug("Updating users (On Air Change)...")
+        self.publish("update_on_air_change", self.on_air_change_allowed)
+
+    def __update_relay_ip(self, cam: int, state: int):
+        camera_ip = self.config.camera_ips[cam]
+        if state == 1 or (self.on_air_change_allowed and (state & 0x1) == 0x1):
+            if self.ip_holder[0] != camera_ip:
+                JOURNAL.record(Kind.RELAY, cam)
+            self.ip_holder[0] = camera_ip
+            LOG.debug(">>> Relay PTZ %d (%s)", cam + 1, camera_ip, extra=NO_RATE_LIMIT)
+        elif self.ip_holder[0] == camera_ip:
+            self.ip_holder[0] = None
+            JOURNAL.record(Kind.RELAY, NO_CAMERA)
+            LOG.debug(">>> Relay disabled", extra=NO_RATE_LIMIT)
+
+    async def __tally_notify(self, changes: Dict[int, int]):
+        for cam, state in changes.items():
+            self.tally_states[cam] = state
+            self.__update_relay_ip(cam, state)
+        self.publish("update_tally", list(changes.items()))
+
+    async def __tally_stale_notify(self, stale: bool):
+        self.tally_stale = stale
+        self.publish("update_tally_stale", stale)
+
+    def __on_air(self, cam: int) -> bool:
+        return cam < len(self.tally_states) and self.tally_states[cam] & 0x2 != 0
+
+    def __camera_state_notify(self, cam: int, state: Optional[dict]):
+        self.publish("update_camera_state", [cam, state])
+
+    def __health_notify(self, cam: int, state: Health):
+        self.publish("update_health", [cam, state.value])
+
+
+async def serve():
+    """Run the coordinator for web workers connecting via COORDINATOR_SOCKET"""
+
+    from constants import COORDINATOR_SOCKET
+    from ipc import IpcServer
+
+    if not COORDINATOR_SOCKET:
+        LOG.error("COORDINATOR_SOCKET must be configured to run the coordinator on its own")
+        return
+    coordinator = Coordinator()
+    await coordinator.start()
+    server = IpcServer(coordinator, COORDINATOR_SOCKET)
+    try:
+        await server.start()
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+        await coordinator.close()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
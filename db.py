@@ -1,71 +1,178 @@
+import asyncio
 import logging
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
-from sqlite3 import connect, Cursor
+from sqlite3 import connect
+from typing import Dict, Tuple, Set, Optional, List
 
-from constants import NUM_CAMERAS, NUM_BUTTONS, DB_FILE
+from constants import NUM_SCENES, DB_FILE, DB_FLUSH_INTERVAL
 
 LOG = logging.getLogger("db")
+# Buttons and their focus values by camera and position, focus values of the scenes by scene and camera
+Tables = Tuple[Dict[Tuple[int, int], dict], Dict[Tuple[int, int], int], Dict[Tuple[int, int], int]]
 
 
 class Database:
-    def __init__(self):
-        if not exists(DB_FILE):
+    """Keeps the positions and scenes tables in memory as authoritative copy, changes are written to SQLite in the
+    background"""
+
+    def __init__(self, num_cameras: int, num_buttons: int):
+        initialize = not exists(DB_FILE)
+        # The connection is only used by the single thread of the executor after initialization
+        self.connection = connect(DB_FILE, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if initialize:
             LOG.info("Initialize sqlite database...")
-            with self.cursor() as cur:
-                cur.execute("CREATE TABLE positions ("
-                            "cam INTEGER NOT NULL, "
-                            "pos INTEGER NOT NULL, "
-                            "name VARCHAR NOT NULL DEFAULT '', "
-                            "btn_class VARCHAR NOT NULL DEFAULT 'btn-secondary', "
-                            "focus INTEGER NOT NULL DEFAULT -1, "
-                            "PRIMARY KEY (cam, pos))")
-                for cam in range(NUM_CAMERAS):
-                    for pos in range(NUM_BUTTONS):
-                        cur.execute("INSERT INTO positions (cam, pos) VALUES (?, ?)", (cam, pos))
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS positions ("
+                                    "cam INTEGER NOT NULL, "
+                                    "pos INTEGER NOT NULL, "
+                                    "name VARCHAR NOT NULL DEFAULT '', "
+                                    "btn_class VARCHAR NOT NULL DEFAULT 'btn-secondary', "
+                                    "focus INTEGER NOT NULL DEFAULT -1, "
+                                    "PRIMARY KEY (cam, pos))")
+            # Scenes have been added later, create them in existing databases as well
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scenes ("
+                                    "scene INTEGER NOT NULL, "
+                                    "cam INTEGER NOT NULL, "
+                                    "focus INTEGER NOT NULL DEFAULT -1, "
+                                    "PRIMARY KEY (scene, cam))")
+        self.num_cameras = num_cameras
+        self.num_buttons = num_buttons
+        self.buttons, self.focus, self.scenes = self.__load(num_cameras, num_buttons)
+        if initialize:
             LOG.info("Initialization complete")
+        self.dirty: Set[Tuple[int, int]] = set()
+        self.dirty_scenes: Set[Tuple[int, int]] = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.flush_task: Optional[asyncio.Task] = None
 
-    @contextmanager
-    def dict_cursor(self) -> Cursor:
-        connection = None
-        try:
-            connection = connect(DB_FILE)
-            connection.row_factory = lambda cursor, row: {c[0]: row[i] for i, c in enumerate(cursor.description)}
-            yield connection.cursor()
-            connection.commit()
-        finally:
-            if connection is not None:
-                connection.close()
-
-    @contextmanager
-    def cursor(self) -> Cursor:
-        connection = None
+    def __load(self, num_cameras: int, num_buttons: int) -> Tables:
+        """Create the missing rows of all cameras and buttons in one transaction and read them.
+
+        Rows of cameras and buttons beyond the configuration are kept, they reappear if the configuration grows again.
+        """
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO positions (cam, pos) VALUES (?, ?)",
+                                        [(cam, pos) for cam in range(num_cameras) for pos in range(num_buttons)])
+            self.connection.executemany("INSERT OR IGNORE INTO scenes (scene, cam) VALUES (?, ?)",
+                                        [(scene, cam) for scene in range(NUM_SCENES) for cam in range(num_cameras)])
+        buttons: Dict[Tuple[int, int], dict] = {}
+        focus: Dict[Tuple[int, int], int] = {}
+        for cam, pos, name, btn_class, pos_focus in self.connection.execute(
+                "SELECT cam, pos, name, btn_class, focus FROM positions WHERE cam < ? AND pos < ? ORDER BY cam, pos",
+                (num_cameras, num_buttons)):
+            buttons[cam, pos] = {"cam": cam, "pos": pos, "name": name, "btn_class": btn_class}
+            focus[cam, pos] = pos_focus
+        # Focus of each camera by scene and camera, -1 if the scene has not been saved
+        scenes: Dict[Tuple[int, int], int] = {}
+        for scene, cam, scene_focus in self.connection.execute(
+                "SELECT scene, cam, focus FROM scenes WHERE scene < ? AND cam < ?", (NUM_SCENES, num_cameras)):
+            scenes[scene, cam] = scene_focus
+        return buttons, focus, scenes
+
+    async def resize(self, num_cameras: int, num_buttons: int) -> List[dict]:
+        """Change the number of cameras and buttons, returns the buttons added"""
+
+        await self.flush()
+        buttons, focus, scenes = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.__load, num_cameras, num_buttons)
+        # Changes made meanwhile are newer than what has been read
+        added = [button for key, button in buttons.items() if key not in self.buttons]
+        self.buttons = {key: self.buttons.get(key, button) for key, button in buttons.items()}
+        self.focus = {key: self.focus.get(key, value) for key, value in focus.items()}
+        self.scenes = {key: self.scenes.get(key, value) for key, value in scenes.items()}
+        self.dirty &= self.buttons.keys()
+        self.dirty_scenes &= self.scenes.keys()
+        self.num_cameras = num_cameras
+        self.num_buttons = num_buttons
+        return added
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self.__flush_periodically())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self.executor.shutdown()
+        self.connection.close()
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(DB_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                LOG.error("Error whilst writing positions to database")
+                logging.exception(e)
+
+    async def flush(self):
+        if not self.dirty and not self.dirty_scenes:
+            return
+        rows = [(self.buttons[key]["name"], self.buttons[key]["btn_class"], self.focus[key]) + key
+                for key in self.dirty]
+        scene_rows = [(self.scenes[key],) + key for key in self.dirty_scenes]
+        dirty, dirty_scenes = self.dirty, self.dirty_scenes
+        # Changes made during the write are collected anew
+        self.dirty = set()
+        self.dirty_scenes = set()
         try:
-            connection = connect(DB_FILE)
-            yield connection.cursor()
-            connection.commit()
-        finally:
-            if connection is not None:
-                connection.close()
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.__write, rows, scene_rows)
+        except BaseException:
+            # Failed rows are written again with the next flush
+            self.dirty |= dirty & self.buttons.keys()
+            self.dirty_scenes |= dirty_scenes & self.scenes.keys()
+            raise
+        LOG.debug("Flushed %d positions and %d scene cameras to database", len(rows), len(scene_rows))
+
+    def __write(self, rows: List[tuple], scene_rows: List[tuple]):
+        with self.connection:
+            self.connection.executemany("UPDATE positions SET name = ?, btn_class = ?, focus = ? "
+                                        "WHERE cam = ? AND pos = ?", rows)
+            self.connection.executemany("UPDATE scenes SET focus = ? WHERE scene = ? AND cam = ?", scene_rows)
 
     def set_button(self, cam: int, pos: int, name: str, btn_class: str):
-        with self.cursor() as cur:
-            cur.execute("UPDATE positions SET name = ?, btn_class = ? WHERE cam = ? AND pos = ?",
-                        (name, btn_class, cam, pos))
+        button = self.buttons[cam, pos]
+        button["name"] = name
+        button["btn_class"] = btn_class
+        self.dirty.add((cam, pos))
 
     def set_focus(self, cam: int, pos: int, focus: int):
-        with self.cursor() as cur:
-            cur.execute("UPDATE positions SET focus = ? WHERE cam = ? AND pos = ?", (focus, cam, pos))
+        if (cam, pos) not in self.focus:
+            raise KeyError((cam, pos))
+        self.focus[cam, pos] = focus
+        self.dirty.add((cam, pos))
 
     def get_focus(self, cam: int, pos: int) -> int:
-        with self.cursor() as cur:
-            cur.execute("SELECT focus FROM positions WHERE cam = ? AND pos = ?", (cam, pos))
-            return cur.fetchone()[0]
+        return self.focus[cam, pos]
 
     def get_data(self) -> list:
-        with self.dict_cursor() as cur:
-            return list(cur.execute("SELECT cam, pos, name, btn_class FROM positions ORDER BY cam, pos"))
+        return list(self.buttons.values())
 
     def clear_buttons(self):
-        with self.cursor() as cur:
-            cur.execute("UPDATE positions SET name = '', btn_class = 'btn-secondary'")
+        for button in self.buttons.values():
+            button["name"] = ""
+            button["btn_class"] = "btn-secondary"
+        self.dirty.update(self.buttons.keys())
+
+    def set_scene_focus(self, scene: int, cam: int, focus: int):
+        if (scene, cam) not in self.scenes:
+            raise KeyError((scene, cam))
+        self.scenes[scene, cam] = focus
+        self.dirty_scenes.add((scene, cam))
+
+    def get_scene(self, scene: int) -> Dict[int, int]:
+        """Focus values by camera, for the cameras saved with the scene"""
+
+        return {cam: self.scenes[scene, cam] for cam in range(self.num_cameras) if self.scenes[scene, cam] != -1}
+
+    def get_scenes(self) -> List[bool]:
+        """Whether each scene has been saved"""
+
+        return [bool(self.get_scene(scene)) for scene in range(NUM_SCENES)]
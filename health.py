@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from enum import Enum
+from typing import Callable, Dict, List, Optional
+
+from constants import HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, HEALTH_DOWN_THRESHOLD
+from visca import CommandSocket
+
+LOG = logging.getLogger("health")
+
+
+class Health(Enum):
+    UP = "up"
+    DEGRADED = "degraded"
+    DOWN = "down"
+
+
+class CameraUnavailableException(Exception):
+    pass
+
+
+class CameraHealth:
+    """Circuit breaker of one camera, fed by health probes and the results of camera jobs.
+
+    After HEALTH_DOWN_THRESHOLD consecutive failures, the camera is down and commands fail right away,
+    until the next successful probe.
+    """
+
+    def __init__(self, cam: int, camera: CommandSocket, notify: Callable[[int, Health], None]):
+        self.cam = cam
+        self.camera = camera
+        self.notify = notify
+        self.state = Health.UP
+        self.failures = 0
+
+    def __set_state(self, state: Health):
+        if state != self.state:
+            LOG.warning("Camera %s is %s", self.camera.ip, state.value)
+            self.state = state
+            self.notify(self.cam, state)
+
+    def record_success(self):
+        self.failures = 0
+        self.__set_state(Health.UP)
+
+    def record_failure(self):
+        self.failures += 1
+        self.__set_state(Health.DOWN if self.failures >= HEALTH_DOWN_THRESHOLD else Health.DEGRADED)
+
+    def check(self):
+        if self.state == Health.DOWN:
+            raise CameraUnavailableException(f"Camera {self.camera.ip} is down")
+
+
+class HealthMonitor:
+    """Periodically probes all cameras with a cheap inquiry"""
+
+    def __init__(self, cameras: List[CommandSocket], notify: Callable[[int, Health], None]):
+        self.notify = notify
+        self.cameras = [CameraHealth(cam, camera, notify) for cam, camera in enumerate(cameras)]
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def set_cameras(self, cameras: List[CommandSocket]):
+        """Change the cameras probed, cameras that remain keep their health"""
+
+        kept = {health.camera: health for health in self.cameras}
+        self.cameras = [kept.get(camera) or CameraHealth(cam, camera, self.notify)
+                        for cam, camera in enumerate(cameras)]
+
+    def states(self) -> Dict[int, Health]:
+        return {health.cam: health.state for health in self.cameras}
+
+    @staticmethod
+    async def __probe(health: CameraHealth):
+        try:
+            await asyncio.wait_for(health.camera.inq_power(), HEALTH_PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, OSError) as e:
+            LOG.debug("Health probe of %s failed: %r", health.camera.ip, e)
+            health.record_failure()
+        except Exception as e:
+            # The camera answered, even if unexpectedly
+            LOG.debug("Health probe of %s answered with error: %r", health.camera.ip, e)
+            health.record_success()
+        else:
+            health.record_success()
+
+    async def __run(self):
+        while True:
+            await asyncio.gather(*[self.__probe(health) for health in self.cameras])
+            await asyncio.sleep(HEALTH_PROBE_INTERVAL)
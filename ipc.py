@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import os
+from itertools import count
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from coordinator import Coordinator
+from metrics import render as render_metrics, WEB_METRICS, REGISTRY
+
+LOG = logging.getLogger("ipc")
+# Maximum length of a message, snapshots and metrics may be sizeable
+MESSAGE_LIMIT = 1 << 22
+# Bytes waiting to be sent to a web worker beyond which it is considered stalled and disconnected
+WRITE_BUFFER_LIMIT = 1 << 24
+
+# Callbacks of the web workers: Published state change (sequence number, event, data)
+# and start or restart of the event stream (epoch, sequence number of the latest state change)
+EventCallback = Callable[[int, str, Any], None]
+ResetCallback = Callable[[int, int], None]
+
+
+def coordinator_metrics() -> str:
+    """Metrics of the coordinator process, web workers render theirs on their own"""
+
+    return render_metrics([metric for metric in REGISTRY if metric not in WEB_METRICS])
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+
+
+class LocalClient:
+    """Runs the coordinator within the web worker process, for a single worker and for tests"""
+
+    def __init__(self, coordinator: Coordinator, on_event: EventCallback, on_reset: ResetCallback):
+        self.coordinator = coordinator
+        self.on_event = on_event
+        self.on_reset = on_reset
+
+    async def start(self):
+        await self.coordinator.start()
+        self.coordinator.subscribe(self.on_event)
+        self.on_reset(self.coordinator.epoch, self.coordinator.seq)
+
+    async def close(self):
+        self.coordinator.unsubscribe(self.on_event)
+        await self.coordinator.close()
+
+    async def request(self, event: str, data: Any) -> dict:
+        return await self.coordinator.handle(event, data)
+
+    async def snapshot(self) -> Tuple[int, dict]:
+        return self.coordinator.snapshot()
+
+    async def metrics(self) -> str:
+        return coordinator_metrics()
+
+
+class IpcServer:
+    """Serves the coordinator to web workers via a Unix socket, using newline delimited JSON messages.
+
+    Workers send requests ({"op": "request"|"snapshot"|"metrics", "id": ..., ...}), which are handled concurrently
+    in order of arrival and answered with {"op": "reply", "id": ..., "result": ...}.
+    Upon connection, a worker receives {"op": "hello", "epoch": ..., "seq": ...}, followed by all state changes
+    ({"op": "event", "seq": ..., "event": ..., "data": ...}) in the order of their sequence numbers.
+    A worker that does not keep up with its messages is disconnected, it resets its clients upon reconnection.
+    """
+
+    def __init__(self, coordinator: Coordinator, path: str):
+        self.coordinator = coordinator
+        self.path = path
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.handlers: Set[asyncio.Task] = set()
+
+    async def start(self):
+        # Remove the socket file left by a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.__serve, self.path, limit=MESSAGE_LIMIT)
+        LOG.info(f"Coordinator listening on {self.path}")
+
+    async def close(self):
+        self.server.close()
+        for handler in self.handlers:
+            handler.cancel()
+        await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def __serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.handlers.add(asyncio.current_task())
+        LOG.info("Web worker connected")
+
+        def send(message: dict):
+            if writer.is_closing():
+                return
+            if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+                LOG.error("Web worker does not keep up with its messages, disconnecting")
+                writer.transport.abort()
+                return
+            writer.write(encode(message))
+
+        def on_event(seq: int, event: str, data: Any):
+            send({"op": "event", "seq": seq, "event": event, "data": data})
+
+        # Requests in progress, finished even if the worker disconnects
+        requests: Set[asyncio.Task] = set()
+        send({"op": "hello", "epoch": self.coordinator.epoch, "seq": self.coordinator.seq})
+        self.coordinator.subscribe(on_event)
+        try:
+            while line := await reader.readline():
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    LOG.error("Invalid message from web worker: %s", e)
+                    continue
+                # Tasks start in order of arrival, so that the jobs for each camera keep that order
+                request = asyncio.create_task(self.__handle(message, send))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            LOG.info("Web worker disconnected")
+            self.coordinator.unsubscribe(on_event)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def __handle(self, message: dict, send: Callable[[dict], None]):
+        try:
+            op = message["op"]
+            if op == "request":
+                result = await self.coordinator.handle(message["event"], message["data"])
+            elif op == "snapshot":
+                seq, state = self.coordinator.snapshot()
+                result = {"seq": seq, "state": state}
+            elif op == "metrics":
+                result = coordinator_metrics()
+            else:
+                LOG.error(f"Unsupported IPC operation {op}")
+                return
+            send({"op": "reply", "id": message["id"], "result": result})
+        except Exception as e:
+            LOG.error("Error handling message from web worker", exc_info=e)
+
+
+class IpcClient:
+    """Connection of a web worker to the coordinator process, reconnecting if lost"""
+
+    def __init__(self, path: str, on_event: EventCallback, on_reset: ResetCallback):
+        self.path = path
+        self.on_event = on_event
+        self.on_reset = on_reset
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.ids = count()
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.__run())
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def __run(self):
+        reconnect_delay = 0.1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=MESSAGE_LIMIT)
+            except OSError as e:
+                LOG.error(f"Cannot connect to coordinator at {self.path}, retry after {reconnect_delay} s: {e}")
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, 2.0)
+                continue
+            reconnect_delay = 0.1
+            LOG.info(f"Connected to coordinator at {self.path}")
+            self.writer = writer
+            try:
+                while line := await reader.readline():
+                    # A message that cannot be handled must not end the connection
+                    try:
+                        self.__receive(json.loads(line))
+                    except Exception as e:
+                        LOG.error("Error handling message from coordinator", exc_info=e)
+            except (ConnectionError, ValueError) as e:
+                # ValueError: Message exceeding MESSAGE_LIMIT
+                LOG.error(f"Connection to coordinator lost: {e}")
+            finally:
+                self.writer = None
+                writer.close()
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Connection to coordinator lost"))
+                self.pending.clear()
+
+    def __receive(self, message: dict):
+        op = message["op"]
+        if op == "event":
+            self.on_event(message["seq"], message["event"], message["data"])
+        elif op == "reply":
+            future = self.pending.pop(message["id"], None)
+            if future is not None and not future.done():
+                future.set_result(message["result"])
+        elif op == "hello":
+            self.on_reset(message["epoch"], message["seq"])
+
+    async def __call(self, message: dict) -> Any:
+        if self.writer is None:
+            raise ConnectionError("Not connected to coordinator")
+        message["id"] = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message["id"]] = future
+        # Written right away, so that requests reach the coordinator in the order they were issued
+        self.writer.write(encode(message))
+        return await future
+
+    async def request(self, event: str, data: Any) -> dict:
+        try:
+            return await self.__call({"op": "request", "event": event, "data": data})
+        except ConnectionError as e:
+            return {"status": "failure", "error": str(e)}
+
+    async def snapshot(self) -> Tuple[int, dict]:
+        reply = await self.__call({"op": "snapshot"})
+        return reply["seq"], reply["state"]
+
+    async def metrics(self) -> str:
+        try:
+            return await self.__call({"op": "metrics"})
+        except ConnectionError:
+            return ""
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from time import time
+from typing import Optional, BinaryIO
+
+from constants import JOURNAL_FLUSH_INTERVAL, JOURNAL_BUFFER_SIZE, JOURNAL_BUFFER_LIMIT
+from metrics import JOURNAL_RECORDS, JOURNAL_DROPPED
+
+LOG = logging.getLogger("journal")
+# Start of every journal file, followed by the format version
+MAGIC = b"PTZJ"
+FILE_HEADER = struct.Struct("<4sH2x")
+VERSION = 1
+# Record header: Wall clock time, kind, camera (NO_CAMERA if not applicable), payload length
+RECORD_HEADER = struct.Struct("<dBBH")
+NO_CAMERA = 0xFF
+
+
+class Kind(IntEnum):
+    # Payload: New tally state (1 byte)
+    TALLY = 1
+    # Relay target switched to the camera, NO_CAMERA if disabled; no payload
+    RELAY = 2
+    # Payload: VISCA packet sent to or received from the camera
+    VISCA_COMMAND = 3
+    VISCA_REPLY = 4
+    # Payload: Client request as JSON ({"event": ..., "data": ...})
+    REQUEST = 5
+
+
+class Journal:
+    """Append-only binary journal of what happened, for post-mortems (see replay.py).
+
+    Recording only appends to a buffer, which is written by a background thread in batches, every
+    JOURNAL_FLUSH_INTERVAL or as soon as it holds JOURNAL_BUFFER_SIZE bytes. Records are dropped (and counted)
+    if writing falls behind by more than JOURNAL_BUFFER_LIMIT bytes. Without an open file, nothing is recorded.
+    """
+
+    def __init__(self):
+        self.file: Optional[BinaryIO] = None
+        self.buffer = bytearray()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        # Created upon opening, bound to the running loop (Python < 3.10 binds it upon creation)
+        self.flush_requested: Optional[asyncio.Event] = None
+
+    def open(self, path: str):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self.flush_requested = asyncio.Event()
+        self.flush_task = asyncio.create_task(self.__flush_periodically())
+        LOG.info("Recording journal to %s", path)
+
+    async def close(self):
+        if self.file is None:
+            return
+        self.flush_task.cancel()
+        try:
+            await self.flush_task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        self.executor.shutdown()
+        self.file.close()
+        self.file = None
+
+    @property
+    def recording(self) -> bool:
+        return self.file is not None
+
+    def record(self, kind: Kind, cam: int = NO_CAMERA, payload: bytes = b""):
+        if self.file is None:
+            return
+        if len(self.buffer) >= JOURNAL_BUFFER_LIMIT:
+            JOURNAL_DROPPED.inc()
+            return
+        # Longer payloads are truncated, the length has 16 bits
+        payload = payload[:0xFFFF]
+        self.buffer += RECORD_HEADER.pack(time(), kind, cam, len(payload))
+        self.buffer += payload
+        JOURNAL_RECORDS.inc()
+        if len(self.buffer) >= JOURNAL_BUFFER_SIZE:
+            self.flush_requested.set()
+
+    async def __flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), JOURNAL_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                LOG.error("Error whilst writing journal", exc_info=e)
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.__write, data)
+
+    def __write(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+
+
+# Journal of this process, opened by the coordinator if JOURNAL_FILE is configured
+JOURNAL = Journal()
@@ -0,0 +1,93 @@
+import atexit
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+from constants import LOG_LEVEL, LOG_LEVELS, LOG_RATE_LIMIT, LOG_RATE_INTERVAL
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Extra of records never suppressed by the rate limit, e.g. state changes: LOG.info(..., extra=NO_RATE_LIMIT)
+NO_RATE_LIMIT = {"rate_limit": False}
+listener: Optional[QueueListener] = None
+
+
+class HexBytes:
+    """Hex representation of bytes for log messages, only computed if the message is actually emitted"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex(" ")
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets pass at most LOG_RATE_LIMIT records of the same message per LOG_RATE_INTERVAL, counting the others.
+
+    Records are considered the same if logger, level and message template (before formatting) match.
+    Warnings, errors and records logged with NO_RATE_LIMIT always pass.
+    """
+
+    def __init__(self, limit: int, interval: float):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # Start of the current interval, records passed and records suppressed, by message
+        self.windows: Dict[Tuple[str, int, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, "rate_limit", True):
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is not None and window[2]:
+                # Report suppressed records with the first record of the next interval
+                record.msg = f"{record.msg} (suppressed {window[2]} similar messages)"
+            if len(self.windows) > 1000:
+                self.windows.clear()
+            self.windows[key] = [now, 1, 0]
+            return True
+        if window[1] < self.limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class LocalQueueHandler(QueueHandler):
+    """Passes records to the writer thread as they are, formatting happens there instead of on the event loop"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging():
+    """Log via a queue to a background thread writing to stderr, with levels and rate limit from constants.py"""
+
+    global listener
+    if listener is not None:
+        return
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+    queue = SimpleQueue()
+    handler = LocalQueueHandler(queue)
+    if LOG_RATE_LIMIT > 0:
+        handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_INTERVAL))
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    listener = QueueListener(queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Write the remaining records upon exit
+    atexit.register(listener.stop)
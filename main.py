@@ -1,177 +1,157 @@
 import asyncio
 import logging
-from asyncio.exceptions import TimeoutError
-from contextlib import asynccontextmanager, closing
-from time import time
-from typing import Optional, List, Any, Set
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Set
 
 from fastapi import FastAPI
 from starlette.requests import Request
-from starlette.responses import HTMLResponse
-from starlette.staticfiles import StaticFiles
+from starlette.responses import HTMLResponse, PlainTextResponse, Response
 from starlette.templating import Jinja2Templates
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
-from constants import TALLY_IDS, CAMERA_IPS, VISCA_UDP_PORT, WEB_TITLE, VISCA_TIMEOUT, RECALL_TIMEOUT
-from db import Database
-from relay import run_relay
-from tally import watch_tallies, stop_watcher
-from visca import CommandSocket, State
+from assets import Asset, StaticAssets, REVALIDATE
+from broadcast import Broadcaster
+from constants import WEB_TITLE, COORDINATOR_SOCKET
+from coordinator import Coordinator, EVENTS
+from ipc import LocalClient, IpcClient
+from logs import setup_logging
+from metrics import WEBSOCKET_EVENT_SECONDS, WEBSOCKET_TIMEOUTS, WEBSOCKET_CLIENTS, WEBSOCKET_QUEUE_DEPTH, \
+    WEB_METRICS, render as render_metrics
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
-)
+setup_logging()
 
 LOG = logging.getLogger("main")
-CAMERAS: List[CommandSocket]
-TALLY_STATES = [0] * len(TALLY_IDS)
-IP_HOLDER: List[Optional[str]] = [None]
-DB: Database
-USERS: Set[WebSocket] = set()
-on_air_change_allowed = False
+USERS = Broadcaster()
+WEBSOCKET_CLIENTS.function = lambda: {(): len(USERS)}
+WEBSOCKET_QUEUE_DEPTH.function = lambda: {(str(client),): client.queue.qsize() for client in USERS.clients.values()}
 
 
-async def update_button(message: Any, data: dict, sender: WebSocket):
-    DB.set_button(**data)
-    if len(USERS) > 1:  # asyncio.wait doesn't accept an empty list
-        LOG.debug("Updating users...")
-        await asyncio.wait([asyncio.create_task(user.send_json(message)) for user in USERS if user != sender])
+async def init(user: WebSocket):
+    seq, state = await COORDINATOR.snapshot()
+    USERS.init(user, seq, state)
 
 
-async def save_pos(data: dict):
-    camera = CAMERAS[data["cam"]]
-    focus = await camera.inq_focus()
-    DB.set_focus(focus=focus, **data)
-    await camera.memory_set(data["pos"])
+async def init_all():
+    try:
+        seq, state = await COORDINATOR.snapshot()
+    except ConnectionError as e:
+        LOG.error(f"Cannot send state to clients: {e}")
+        return
+    for user in list(USERS.clients):
+        USERS.init(user, seq, state)
 
 
-async def recall_pos(data: dict):
-    camera = CAMERAS[data["cam"]]
-    focus = DB.get_focus(**data)
-    await camera.recall(data["pos"], focus)
+def coordinator_reset(epoch: int, seq: int):
+    # Clients cannot catch up if state changes were missed while the coordinator was unavailable
+    if USERS.reset(epoch, seq):
+        asyncio.create_task(init_all())
 
 
-async def init(user: WebSocket):
-    await user.send_json({
-        "event": "init",
-        "data": {
-            "camera_ips": CAMERA_IPS,
-            "all_pos": DB.get_data(),
-            "tally_states": TALLY_STATES,
-            "on_air_change_allowed": on_air_change_allowed
-        }
-    })
-
-
-async def update_on_air_change(allow: bool, sender: WebSocket):
-    global on_air_change_allowed
-    on_air_change_allowed = allow
-    # Update relay state if there is a camera that is selected for preview and program
-    for cam, state in enumerate(TALLY_STATES):
-        if state == 3:
-            update_relay_ip(cam, state)
-    if len(USERS) > 1:  # asyncio.wait doesn't accept an empty list
-        message = {
-            "event": "update_on_air_change",
-            "data": on_air_change_allowed
-        }
-        LOG.debug("Updating users (On Air Change)...")
-        await asyncio.wait([asyncio.create_task(user.send_json(message)) for user in USERS if user != sender])
-
-
-def update_relay_ip(cam: int, state: int):
-    if state == 1 or (on_air_change_allowed and (state & 0x1) == 0x1):
-        IP_HOLDER[0] = CAMERA_IPS[cam]
-        LOG.debug(f">>> Relay PTZ {cam + 1} ({CAMERA_IPS[cam]})")
-    elif IP_HOLDER[0] == CAMERA_IPS[cam]:
-        IP_HOLDER[0] = None
-        LOG.debug(">>> Relay disabled")
-
-
-async def tally_notify(cam: int, state: int):
-    TALLY_STATES[cam] = state
-    update_relay_ip(cam, state)
-    if USERS:
-        message = {
-            "event": "update_tally",
-            "data": TALLY_STATES
-        }
-        await asyncio.wait([asyncio.create_task(user.send_json(message)) for user in USERS])
+# Web workers share the coordinator process if configured, otherwise the coordinator runs in-process
+if COORDINATOR_SOCKET:
+    COORDINATOR = IpcClient(COORDINATOR_SOCKET, USERS.publish, coordinator_reset)
+else:
+    COORDINATOR = LocalClient(Coordinator(), USERS.publish, coordinator_reset)
 
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
-    global CAMERAS, DB
+    await COORDINATOR.start()
     try:
-        # Init camera controls
-        CAMERAS = [CommandSocket(ip, VISCA_UDP_PORT) for ip in CAMERA_IPS]
-        # Open database
-        DB = Database()
-        # Start tally state watcher client
-        watch_tallies(tally_notify)
-        # Start VISCA relay
-        with closing(await run_relay(IP_HOLDER)):
-            # Run FastAPI server
-            yield
+        # Run FastAPI server
+        yield
     finally:
-        # Terminate tally state watcher
-        await stop_watcher()
+        await COORDINATOR.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Static files and the page are prepared once, clients cache assets for good as their URLs contain content hashes
+ASSETS = StaticAssets("static")
 templates = Jinja2Templates(directory="templates")
-startup_time = int(time())
+INDEX = Asset(templates.get_template("index.html").render(title=WEB_TITLE, static=ASSETS.urls).encode(),
+              "text/html; charset=utf-8")
 
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request, "title": WEB_TITLE,
-                                                     "startup_time": startup_time})
+    return INDEX.response(request, REVALIDATE)
+
+
+@app.get("/static/{name}")
+async def static(name: str, request: Request) -> Response:
+    return ASSETS.response(name, request)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return render_metrics(WEB_METRICS) + await COORDINATOR.metrics()
+
+
+async def handle_request(websocket: WebSocket, message: dict):
+    """Handle one request of a client and reply with its result, if the client passed a request ID"""
+
+    start = perf_counter()
+    event = None
+    try:
+        event = message["event"]
+        if event == "resync":
+            # Client missed a state change
+            try:
+                await init(websocket)
+                result = {"status": "success"}
+            except ConnectionError as e:
+                result = {"status": "failure", "error": str(e)}
+        else:
+            result = await COORDINATOR.request(event, message["data"])
+    except (KeyError, TypeError) as e:
+        LOG.warning("Malformed request %r: %r", message, e)
+        result = {"status": "failure", "error": "Malformed request"}
+    except Exception as e:
+        LOG.error("Error handling request %r", message, exc_info=e)
+        result = {"status": "failure", "error": str(e)}
+    if result["status"] == "timeout":
+        WEBSOCKET_TIMEOUTS.inc(event)
+    # Unsupported events are not measured, their names are up to the client
+    if event == "resync" or (isinstance(event, str) and event in EVENTS):
+        WEBSOCKET_EVENT_SECONDS.observe(perf_counter() - start, event)
+    if isinstance(message, dict) and message.get("id") is not None:
+        USERS.send(websocket, "result", dict(result, id=message["id"]))
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     ws_client = websocket.client
-    LOG.info(f"Websocket client {(ws_client.host, ws_client.port)} connected")
-    USERS.add(websocket)
+    LOG.info("Websocket client %s:%d connected", ws_client.host, ws_client.port)
+    params = websocket.query_params
+    USERS.add(websocket, binary=params.get("binary") == "1")
+    # Requests in progress, finished even if the client disconnects
+    requests: Set[asyncio.Task] = set()
     try:
-        await init(websocket)
+        # Reconnecting clients only receive the state changes they missed, if still available
+        try:
+            epoch, since = int(params["epoch"]), int(params["since"])
+        except (KeyError, ValueError):
+            # First connection, or no valid resume point
+            resumed = False
+        else:
+            resumed = USERS.resume(websocket, epoch, since)
+        if not resumed:
+            await init(websocket)
         while True:
             message = await websocket.receive_json()
-            event = message["event"]
-            data = message["data"]
-            try:
-                if event == "update_button":
-                    await asyncio.wait_for(update_button(message, data, websocket), VISCA_TIMEOUT)
-                elif event == "save_pos":
-                    await asyncio.wait_for(save_pos(data), VISCA_TIMEOUT)
-                elif event == "recall_pos":
-                    await asyncio.wait_for(recall_pos(data), RECALL_TIMEOUT)
-                elif event == "focus_lock":
-                    await asyncio.wait([asyncio.create_task(camera.set_focus_lock(State.ON if data else State.OFF))
-                                        for camera in CAMERAS],
-                                       timeout=VISCA_TIMEOUT)
-                elif event == "power":
-                    await asyncio.wait([asyncio.create_task(camera.set_power(State.ON if data else State.OFF))
-                                        for camera in CAMERAS],
-                                       timeout=VISCA_TIMEOUT)
-                elif event == "allow_on_air_change":
-                    await asyncio.wait_for(update_on_air_change(data, websocket), VISCA_TIMEOUT)
-                elif event == "clear_all":
-                    DB.clear_buttons()
-                    await asyncio.wait([asyncio.create_task(init(user)) for user in USERS])
-                elif event == "reconnect":
-                    await stop_watcher()
-                    watch_tallies(tally_notify)
-                else:
-                    LOG.error(f"Unsupported event: {event} with data {data}")
-            except TimeoutError as e:
-                LOG.warning("Timeout error during visca operation", exc_info=e)
+            # Requests are handled concurrently, tasks start in order of arrival and submit their camera jobs
+            # right away, so that the jobs for each camera keep that order
+            request = asyncio.create_task(handle_request(websocket, message))
+            requests.add(request)
+            request.add_done_callback(requests.discard)
     except WebSocketDisconnect as d:
-        LOG.info(f"Websocket client {(ws_client.host, ws_client.port)} disconnected with code {d.code}")
+        LOG.info("Websocket client %s:%d disconnected with code %d", ws_client.host, ws_client.port, d.code)
+    except ConnectionError as e:
+        LOG.error("Websocket client %s:%d rejected: %s", ws_client.host, ws_client.port, e)
+        # 1013: Try again later
+        await websocket.close(1013)
     finally:
-        USERS.remove(websocket)
+        await USERS.remove(websocket)
@@ -0,0 +1,127 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+
+class Metric:
+    """Base of all metrics, values are kept per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        REGISTRY.append(self)
+
+    def format_labels(self, values: Tuple, extra: str = "") -> str:
+        labels = [f'{name}="{value}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self.format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Gauge, either set explicitly or obtained from a function upon rendering"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 function: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, description, label_names)
+        self.values: Dict[Tuple, float] = {}
+        self.function = function
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def samples(self) -> List[str]:
+        values = self.function() if self.function is not None else self.values
+        return [f"{self.name}{self.format_labels(labels)} {value}" for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+        # Per label values: Count per bucket (non-cumulative, last one is +Inf), sum
+        self.counts: Dict[Tuple, List[int]] = {}
+        self.sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self.format_labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self.format_labels(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{self.format_labels(labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render(metrics: Optional[Sequence[Metric]] = None) -> str:
+    """Render the given (by default all) metrics in the Prometheus text exposition format"""
+
+    return "\n".join(metric.render() for metric in (REGISTRY if metrics is None else metrics)) + "\n"
+
+
+VISCA_REQUEST_SECONDS = Histogram("ptzctrl_visca_request_seconds", "Round trip time of VISCA requests",
+                                  ("camera", "type"))
+VISCA_REQUESTS = Counter("ptzctrl_visca_requests_total", "VISCA requests by result", ("camera", "result"))
+RECALL_SECONDS = Histogram("ptzctrl_recall_seconds", "Duration of recalls until focus is applied", ("camera",))
+WEBSOCKET_EVENT_SECONDS = Histogram("ptzctrl_websocket_event_seconds", "Handling time of WebSocket events",
+                                    ("event",))
+WEBSOCKET_TIMEOUTS = Counter("ptzctrl_websocket_timeouts_total", "WebSocket events that timed out", ("event",))
+TALLY_CHANGES = Counter("ptzctrl_tally_changes_total", "Tally state changes", ("camera",))
+TALLY_PROPAGATION_SECONDS = Histogram("ptzctrl_tally_propagation_seconds",
+                                      "Time from receiving a tally change until relay and clients are updated")
+RELAY_PACKETS = Counter("ptzctrl_relay_packets_total", "Datagrams forwarded by the relay", ("direction",))
+RELAY_DROPS = Counter("ptzctrl_relay_drops_total", "Datagrams not forwarded by the relay", ("reason",))
+RELAY_FORWARD_SECONDS = Histogram("ptzctrl_relay_forward_seconds", "Processing time of relayed requests")
+CAMERA_HEALTH = Gauge("ptzctrl_camera_health", "Camera health (0 up, 1 degraded, 2 down)", ("camera",))
+JOURNAL_RECORDS = Counter("ptzctrl_journal_records_total", "Records written to the journal")
+JOURNAL_DROPPED = Counter("ptzctrl_journal_dropped_total", "Records dropped because writing the journal fell behind")
+WEBSOCKET_CLIENTS = Gauge("ptzctrl_websocket_clients", "Connected WebSocket clients")
+WEBSOCKET_QUEUE_DEPTH = Gauge("ptzctrl_websocket_queue_depth", "Frames waiting to be sent, per WebSocket client",
+                              ("client",))
+# Metrics of the web workers, all others belong to the coordinator
+WEB_METRICS = (WEBSOCKET_EVENT_SECONDS, WEBSOCKET_TIMEOUTS, WEBSOCKET_CLIENTS, WEBSOCKET_QUEUE_DEPTH)
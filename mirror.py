@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from constants import MIRROR_POLL_INTERVAL, MIRROR_POLL_INTERVAL_MOVING, MIRROR_POLL_INTERVAL_ON_AIR, \
+    MIRROR_POLL_TIMEOUT, MIRROR_ACTIVITY_TIME
+from health import CameraHealth, Health
+from visca import CommandSocket, CameraState, State, AnswerException
+
+LOG = logging.getLogger("mirror")
+
+
+class CameraMirror:
+    """Latest known state of one camera, polled at a rate depending on what the camera does.
+
+    A camera is considered moving while its position changes between polls, and for MIRROR_ACTIVITY_TIME after
+    it has been told to move (recall, relayed command), since it may not have started moving at the next poll yet.
+    """
+
+    def __init__(self, cam: int, camera: CommandSocket, health: CameraHealth,
+                 notify: Callable[[int, Optional[dict]], None]):
+        self.cam = cam
+        self.camera = camera
+        self.health = health
+        self.notify = notify
+        self.state: Optional[CameraState] = None
+        self.moving = False
+        # Loop time at which the latest successful poll was sent, of the latest activity and of the latest change
+        # without movement
+        self.polled_at = 0.0
+        self.active_at = 0.0
+        self.changed_at = 0.0
+        self.wakeup = asyncio.Event()
+
+    def to_dict(self) -> Optional[dict]:
+        if self.state is None:
+            return None
+        return {"pan": self.state.pan, "tilt": self.state.tilt, "zoom": self.state.zoom, "focus": self.state.focus,
+                "autofocus": self.state.autofocus == State.ON, "moving": self.moving}
+
+    def touch(self):
+        """The camera is about to move, poll it right away and fast until it stops"""
+
+        self.active_at = asyncio.get_running_loop().time()
+        self.wakeup.set()
+
+    def invalidate(self):
+        """The camera state is about to change without movement (e.g. focus lock, power), poll it right away"""
+
+        self.changed_at = asyncio.get_running_loop().time()
+        self.wakeup.set()
+
+    def cached_focus(self) -> Optional[int]:
+        """Focus value of the latest poll, if it still applies: The camera has neither moved nor been controlled
+        since, and its focus does not change by itself (AF off)"""
+
+        if self.state is None or self.moving or self.polled_at <= max(self.active_at, self.changed_at) \
+                or self.state.autofocus == State.ON:
+            return None
+        return self.state.focus
+
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        state = await asyncio.wait_for(self.camera.inq_state(), MIRROR_POLL_TIMEOUT)
+        # The focus changes by itself with AF, only pan, tilt and zoom are movement
+        moved = self.state is not None and state[:3] != self.state[:3]
+        moving = moved or start < self.active_at + MIRROR_ACTIVITY_TIME
+        # Every state change is kept for resuming clients, so clients are only notified when the camera starts or
+        # stops moving (all they show), not of each position while it moves. The full state is in the snapshot.
+        changed = self.state is None or moving != self.moving
+        self.state = state
+        self.moving = moving
+        self.polled_at = start
+        if changed:
+            self.notify(self.cam, self.to_dict())
+
+
+class StateMirror:
+    """Mirrors the state of all PTZ cameras, each polled on its own schedule"""
+
+    def __init__(self, cameras: List[CommandSocket], health: List[CameraHealth], on_air: Callable[[int], bool],
+                 notify: Callable[[int, Optional[dict]], None]):
+        self.notify = notify
+        self.cameras = [CameraMirror(cam, camera, camera_health, notify)
+                        for cam, (camera, camera_health) in enumerate(zip(cameras, health))]
+        self.by_ip: Dict[str, CameraMirror] = {mirror.camera.ip: mirror for mirror in self.cameras}
+        self.on_air = on_air
+        self.tasks: Dict[CameraMirror, asyncio.Task] = {}
+        self.running = False
+
+    def start(self):
+        self.running = MIRROR_POLL_INTERVAL > 0
+        if self.running:
+            self.tasks = {mirror: asyncio.create_task(self.__run(mirror)) for mirror in self.cameras}
+
+    async def close(self):
+        self.running = False
+        await self.__stop(list(self.tasks))
+
+    async def __stop(self, mirrors: List[CameraMirror]):
+        tasks = [self.tasks.pop(mirror) for mirror in mirrors if mirror in self.tasks]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def set_cameras(self, cameras: List[CommandSocket], health: List[CameraHealth]):
+        """Change the cameras mirrored, cameras that remain keep their state and schedule"""
+
+        kept = {mirror.camera: mirror for mirror in self.cameras}
+        self.cameras = [kept.pop(camera, None) or CameraMirror(cam, camera, camera_health, self.notify)
+                        for cam, (camera, camera_health) in enumerate(zip(cameras, health))]
+        self.by_ip = {mirror.camera.ip: mirror for mirror in self.cameras}
+        await self.__stop(list(kept.values()))
+        if self.running:
+            for mirror in self.cameras:
+                if mirror not in self.tasks:
+                    self.tasks[mirror] = asyncio.create_task(self.__run(mirror))
+
+    def states(self) -> List[Optional[dict]]:
+        return [mirror.to_dict() for mirror in self.cameras]
+
+    def touch_ip(self, ip: str):
+        mirror = self.by_ip.get(ip)
+        if mirror is not None:
+            mirror.touch()
+
+    def __interval(self, mirror: CameraMirror) -> float:
+        # Keep traffic to cameras on air low
+        if self.on_air(mirror.cam):
+            return MIRROR_POLL_INTERVAL_ON_AIR
+        return MIRROR_POLL_INTERVAL
+
+    async def __run(self, mirror: CameraMirror):
+        while True:
+            # Cameras that are down are left to the health probes
+            if mirror.health.state != Health.DOWN:
+                try:
+                    await mirror.poll()
+                except (asyncio.TimeoutError, OSError, AnswerException) as e:
+                    LOG.debug("Polling the state of %s failed: %r", mirror.camera.ip, e)
+                except Exception as e:
+                    # E.g. an unknown AF mode, polling goes on
+                    LOG.warning("Unexpected state of %s: %r", mirror.camera.ip, e)
+            if mirror.moving:
+                await asyncio.sleep(MIRROR_POLL_INTERVAL_MOVING)
+            else:
+                # Activity (also during the poll) triggers the next poll right away
+                try:
+                    await asyncio.wait_for(mirror.wakeup.wait(), self.__interval(mirror))
+                except asyncio.TimeoutError:
+                    pass
+            mirror.wakeup.clear()
@@ -0,0 +1,44 @@
+import json
+import struct
+from enum import IntEnum
+from typing import Any, Optional
+
+# Version of the WebSocket protocol, sent to clients with the initial state
+VERSION = 6
+
+
+class Opcode(IntEnum):
+    UPDATE_TALLY = 1
+    CLEAR_BUTTONS = 2
+    UPDATE_ON_AIR_CHANGE = 3
+    UPDATE_CAMERA_STATE = 4
+
+
+# Binary frames start with opcode and sequence number, followed by the event specific payload
+HEADER = struct.Struct("!BI")
+# Camera, flags (state known, autofocus, moving), pan, tilt, zoom, focus
+CAMERA_STATE = struct.Struct("!BBhhHH")
+
+
+def encode_json(event: str, seq: int, data: Any) -> str:
+    return json.dumps({"event": event, "seq": seq, "data": data}, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode_binary(event: str, seq: int, data: Any) -> Optional[bytes]:
+    """Compact encoding of frequent, purely numeric events, returns None for events only available as JSON"""
+
+    if event == "update_tally":
+        # Pairs of camera and state
+        return HEADER.pack(Opcode.UPDATE_TALLY, seq) + bytes(value for change in data for value in change)
+    elif event == "clear_buttons":
+        return HEADER.pack(Opcode.CLEAR_BUTTONS, seq)
+    elif event == "update_on_air_change":
+        return HEADER.pack(Opcode.UPDATE_ON_AIR_CHANGE, seq) + bytes((data,))
+    elif event == "update_camera_state":
+        cam, state = data
+        if state is None:
+            return HEADER.pack(Opcode.UPDATE_CAMERA_STATE, seq) + CAMERA_STATE.pack(cam, 0, 0, 0, 0, 0)
+        flags = 0x1 | (0x2 if state["autofocus"] else 0) | (0x4 if state["moving"] else 0)
+        return HEADER.pack(Opcode.UPDATE_CAMERA_STATE, seq) + CAMERA_STATE.pack(
+            cam, flags, state["pan"], state["tilt"], state["zoom"], state["focus"])
+    return None
@@ -1,47 +1,346 @@
 import asyncio
 import logging
-from typing import Optional, List
+from time import perf_counter
+from typing import Optional, List, Dict, Tuple, Callable
 
+from constants import VISCA_UDP_PORT, RELAY_UDP_PORT, RELAY_CAMERA_PORTS, RELAY_SESSION_TIMEOUT, \
+    RELAY_VISCA_OVER_IP, RELAY_DRIVE_INTERVAL
+from metrics import RELAY_PACKETS, RELAY_DROPS, RELAY_FORWARD_SECONDS
 
 LOG = logging.getLogger("relay")
+# VISCA over IP: Header of a sequence number reset (control command), sequence number 0
+VISCA_OVER_IP_RESET = bytes([0x02, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x01])
+# VISCA over IP: Payload type of replies
+VISCA_OVER_IP_REPLY = bytes([0x01, 0x11])
+# Number of sequence numbers remembered per session for translating replies
+SEQUENCE_WINDOW = 64
+# Number of datagrams kept per session until its upstream socket is ready, further ones are dropped
+BACKLOG_LIMIT = 64
+# Offset of the VISCA message within a datagram
+PAYLOAD_OFFSET = 8 if RELAY_VISCA_OVER_IP else 0
+# Kinds of continuous drive commands
+PAN_TILT_DRIVE = 0
+ZOOM_DRIVE = 1
 
 
-async def run_relay(ip_holder: List[Optional[str]]):
-    loop = asyncio.get_running_loop()
-    transport, _ = await loop.create_datagram_endpoint(
-        lambda: DatagramProtocol(ip_holder),
-        local_addr=('0.0.0.0', 1259)
-    )
-    return transport
+def drive_kind(data: bytes) -> Optional[int]:
+    """Detect continuous drive commands, i.e. pan-tilt drive (8x 01 06 01 VV WW XX YY FF)
+    and zoom (8x 01 04 07 pp FF)"""
 
+    o = PAYLOAD_OFFSET
+    if len(data) == o + 9 and data[o + 1] == 0x01 and data[o + 2] == 0x06 and data[o + 3] == 0x01:
+        return PAN_TILT_DRIVE
+    if len(data) == o + 6 and data[o + 1] == 0x01 and data[o + 2] == 0x04 and data[o + 3] == 0x07:
+        return ZOOM_DRIVE
+    return None
 
-class DatagramProtocol(asyncio.DatagramProtocol):
-    def __init__(self, ip_holder: List[Optional[str]]):
+
+def is_drive_stop(data: bytes, kind: int) -> bool:
+    o = PAYLOAD_OFFSET
+    if kind == PAN_TILT_DRIVE:
+        return data[o + 6] == 0x03 and data[o + 7] == 0x03
+    return data[o + 4] == 0x00
+
+
+def is_command(data: bytes) -> bool:
+    """Commands (8x 01 ...) change the camera state, unlike inquiries (8x 09 ...)"""
+
+    return len(data) > PAYLOAD_OFFSET + 1 and data[PAYLOAD_OFFSET + 1] == 0x01
+
+
+async def run_relay(ip_holder: List[Optional[str]], camera_ips: List[str],
+                    on_command: Optional[Callable[[str], None]] = None):
+    relay = Relay(ip_holder, camera_ips, on_command)
+    await relay.start()
+    return relay
+
+
+class Relay:
+    """Forwards VISCA datagrams of external controllers to the cameras, NAT-style.
+
+    Each pair of controller address and camera gets a session with a dedicated upstream socket,
+    so the replies of a camera are routed back to the controller that sent the request.
+    The main port relays to the camera in ip_holder, the optional camera ports to a fixed camera each.
+    on_command is called with the camera IP for each relayed command.
+    """
+
+    def __init__(self, ip_holder: List[Optional[str]], camera_ips: List[str],
+                 on_command: Optional[Callable[[str], None]] = None):
         self.ip_holder = ip_holder
-        self.client_addr = None
+        self.camera_ips = camera_ips
+        self.on_command = on_command
+        # Sessions by client address and camera IP
+        self.sessions: Dict[Tuple[str, int], Dict[str, Session]] = {}
+        # Rate limiting of drive commands by camera IP, one throttle per kind of drive command
+        self.throttles: Dict[str, List[DriveThrottle]] = {}
+        self.listeners: List[asyncio.DatagramTransport] = []
+        # Listeners of the camera ports, in the order of RELAY_CAMERA_PORTS
+        self.camera_listeners: List[ListenerProtocol] = []
+        self.expiry_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for port in [RELAY_UDP_PORT] + RELAY_CAMERA_PORTS:
+            fixed = port != RELAY_UDP_PORT
+            transport, listener = await loop.create_datagram_endpoint(
+                lambda fixed=fixed: ListenerProtocol(self, "" if fixed else None),
+                local_addr=('0.0.0.0', port)
+            )
+            self.listeners.append(transport)
+            if fixed:
+                self.camera_listeners.append(listener)
+        self.set_camera_ips(self.camera_ips)
+        self.expiry_task = asyncio.create_task(self.__expire_sessions())
+
+    def close(self):
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+        for throttles in self.throttles.values():
+            for throttle in throttles:
+                throttle.cancel()
+        self.throttles.clear()
+        for sessions in self.sessions.values():
+            for session in sessions.values():
+                session.close()
+        self.sessions.clear()
+        for transport in self.listeners:
+            transport.close()
+
+    def set_camera_ips(self, camera_ips: List[str]):
+        """Point the camera ports to the cameras, ports without a camera drop datagrams"""
+
+        self.camera_ips = camera_ips
+        for cam, listener in enumerate(self.camera_listeners):
+            listener.camera_ip = camera_ips[cam] if cam < len(camera_ips) else ""
+
+    def forward(self, listener: asyncio.DatagramTransport, data: bytes, addr: Tuple[str, int], camera_ip: str):
+        sessions = self.sessions.get(addr)
+        if sessions is None:
+            sessions = self.sessions[addr] = {}
+        session = sessions.get(camera_ip)
+        if session is None:
+            LOG.info("New relay session %s => %s", addr, camera_ip)
+            session = sessions[camera_ip] = Session(listener, addr, camera_ip, self.__drop_session)
+        if self.on_command is not None and is_command(data):
+            self.on_command(camera_ip)
+        if RELAY_DRIVE_INTERVAL > 0:
+            kind = drive_kind(data)
+            if kind is not None:
+                throttles = self.throttles.get(camera_ip)
+                if throttles is None:
+                    throttles = self.throttles[camera_ip] = [DriveThrottle(), DriveThrottle()]
+                throttles[kind].submit(session, data, is_drive_stop(data, kind))
+                return
+            if is_command(data):
+                # A drive command sent after another command (e.g. preset recall) would override it
+                for throttle in self.throttles.get(camera_ip, ()):
+                    throttle.discard()
+        session.send(data)
+
+    def __drop_session(self, session: "Session"):
+        """Forget a session whose upstream socket cannot be opened, the next datagram tries again"""
+
+        sessions = self.sessions.get(session.client_addr, {})
+        if sessions.get(session.camera_ip) is session:
+            del sessions[session.camera_ip]
+            if not sessions:
+                del self.sessions[session.client_addr]
+
+    async def __expire_sessions(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RELAY_SESSION_TIMEOUT / 2)
+            deadline = loop.time() - RELAY_SESSION_TIMEOUT
+            for addr, sessions in list(self.sessions.items()):
+                for camera_ip, session in list(sessions.items()):
+                    if session.last_active < deadline:
+                        LOG.info("Relay session %s => %s expired", addr, camera_ip)
+                        session.close()
+                        del sessions[camera_ip]
+                if not sessions:
+                    del self.sessions[addr]
+
+
+class ListenerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, relay: Relay, camera_ip: Optional[str]):
+        self.relay = relay
+        # Fixed camera of a camera port ("" if none), None for the main port
+        self.camera_ip = camera_ip
         self.transport = None
 
     def connection_made(self, transport):
         self.transport = transport
 
-    def connection_lost(self, _exc):
-        self.transport.close()
-
     def error_received(self, exc):
-        LOG.error("Error in UDP relay transport")
-        logging.exception(exc)
+        LOG.error("Error in UDP relay transport", exc_info=exc)
 
     def datagram_received(self, data, addr):
-        if not self.ip_holder[0]:
+        camera_ip = self.relay.ip_holder[0] if self.camera_ip is None else self.camera_ip
+        if not camera_ip:
             # Without a valid destination, incoming UDP segments will be ignored
+            RELAY_DROPS.inc("no_target")
             return
+        start = perf_counter()
+        self.relay.forward(self.transport, data, addr, camera_ip)
+        RELAY_FORWARD_SECONDS.observe(perf_counter() - start)
+
+
+class Session(asyncio.DatagramProtocol):
+    """Upstream socket of one client to one camera, replies are sent back to the client via the listener"""
+
+    def __init__(self, listener: asyncio.DatagramTransport, client_addr: Tuple[str, int], camera_ip: str,
+                 on_failure: Callable[["Session"], None]):
+        self.listener = listener
+        self.client_addr = client_addr
+        self.camera_ip = camera_ip
+        self.on_failure = on_failure
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Datagrams received before the upstream socket is ready
+        self.backlog: List[bytes] = []
+        loop = asyncio.get_running_loop()
+        self.last_active = loop.time()
+        # VISCA over IP: The camera sees the sequence numbers of this session only, mapped to those of the client
+        self.seq = 0
+        self.client_seqs: Dict[int, bytes] = {}
+        self.open_task = asyncio.create_task(self.__open())
+
+    async def __open(self):
+        try:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: self,
+                remote_addr=(self.camera_ip, VISCA_UDP_PORT)
+            )
+        except OSError as e:
+            LOG.error("Cannot open relay session to %s: %s", self.camera_ip, e)
+            RELAY_DROPS.inc("no_session", amount=len(self.backlog))
+            self.backlog = None
+            self.on_failure(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if RELAY_VISCA_OVER_IP:
+            transport.sendto(VISCA_OVER_IP_RESET)
+        for data in self.backlog:
+            transport.sendto(self.__map_request(data) if RELAY_VISCA_OVER_IP else data)
+        self.backlog = None
+
+    def error_received(self, exc):
+        LOG.error("Error in UDP relay session to %s", self.camera_ip, exc_info=exc)
+
+    def send(self, data: bytes):
+        RELAY_PACKETS.inc("upstream")
+        self.last_active = asyncio.get_running_loop().time()
+        if self.transport is None:
+            if self.backlog is None or len(self.backlog) >= BACKLOG_LIMIT:
+                # Upstream socket failed to open, or is not ready for long
+                RELAY_DROPS.inc("no_session")
+            else:
+                self.backlog.append(data)
+        elif RELAY_VISCA_OVER_IP:
+            self.transport.sendto(self.__map_request(data))
         else:
-            known_server = (self.ip_holder[0], 1259)
+            self.transport.sendto(data)
+
+    def answer(self, data: bytes):
+        """Answer a command locally with ACK and completion, for commands not relayed (superseded drive commands)"""
+
+        o = PAYLOAD_OFFSET
+        if len(data) <= o:
+            return
+        # The camera address of the request (8x) becomes the sender of the reply (x + 8)0
+        sender = ((data[o] & 0x0F) + 8) << 4
+        for reply in (bytes([sender, 0x41, 0xFF]), bytes([sender, 0x51, 0xFF])):
+            if RELAY_VISCA_OVER_IP:
+                reply = VISCA_OVER_IP_REPLY + len(reply).to_bytes(2, "big") + data[4:8] + reply
+            self.listener.sendto(reply, self.client_addr)
+
+    def datagram_received(self, data, addr):
+        if RELAY_VISCA_OVER_IP:
+            data = self.__map_reply(data)
+            if data is None:
+                return
+        RELAY_PACKETS.inc("downstream")
+        self.listener.sendto(data, self.client_addr)
+
+    def __map_request(self, data: bytes):
+        if len(data) < 8:
+            return data
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.client_seqs[self.seq] = data[4:8]
+        self.client_seqs.pop((self.seq - SEQUENCE_WINDOW) & 0xFFFFFFFF, None)
+        packet = bytearray(data)
+        packet[4:8] = self.seq.to_bytes(4, "big")
+        return packet
 
-        if addr == known_server:
-            # Safety check, should actually be impossible since that would be a response without a prior request
-            if self.client_addr is not None:
-                self.transport.sendto(data, self.client_addr)
+    def __map_reply(self, data: bytes):
+        if len(data) < 8:
+            return data
+        client_seq = self.client_seqs.get(int.from_bytes(data[4:8], "big"))
+        if client_seq is None:
+            # Reply to the sequence number reset of this session, or too old
+            return None
+        packet = bytearray(data)
+        packet[4:8] = client_seq
+        return packet
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
         else:
-            self.client_addr = addr
-            self.transport.sendto(data, known_server)
+            self.open_task.cancel()
+
+
+class DriveThrottle:
+    """Limits one kind of drive command for one camera to one command per RELAY_DRIVE_INTERVAL.
+
+    Commands arriving in between replace each other (latest wins) and are sent at the end of the interval.
+    Stop commands are sent immediately and discard a pending command. Commands not relayed are answered locally,
+    so that controllers waiting for the reply to each command do not stall.
+    """
+
+    def __init__(self):
+        self.last_sent = 0.0
+        self.pending_session: Optional[Session] = None
+        self.pending_data: Optional[bytes] = None
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def submit(self, session: "Session", data: bytes, stop: bool):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if stop or (self.handle is None and now - self.last_sent >= RELAY_DRIVE_INTERVAL):
+            self.discard()
+            self.last_sent = now
+            session.send(data)
+            return
+        if self.pending_data is not None:
+            self.__supersede()
+        self.pending_session = session
+        self.pending_data = data
+        if self.handle is None:
+            self.handle = loop.call_at(self.last_sent + RELAY_DRIVE_INTERVAL, self.__flush)
+
+    def __flush(self):
+        self.handle = None
+        self.last_sent = asyncio.get_running_loop().time()
+        self.pending_session.send(self.pending_data)
+        self.pending_session = None
+        self.pending_data = None
+
+    def __supersede(self):
+        LOG.debug("Drive command superseded")
+        RELAY_DROPS.inc("superseded")
+        self.pending_session.answer(self.pending_data)
+
+    def discard(self):
+        """Drop the pending command, it is answered locally"""
+
+        if self.pending_data is not None:
+            self.__supersede()
+        self.cancel()
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending_session = None
+        self.pending_data = None
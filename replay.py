@@ -0,0 +1,195 @@
+"""Reconstructs timelines from a journal (see journal.py) or re-drives a (simulated) system with its records.
+
+Print the timeline of PTZ 2 from 19:30 on:   python replay.py journal.bin --cam 2 --start 19:30
+Count records by kind and camera:            python replay.py journal.bin --stats
+Re-drive ptzctrl, e.g. running against the simulated cameras of the bench, at twice the speed
+(websockets is required, tally changes are served to ptzctrl as tally source):
+    python replay.py journal.bin --drive ws://localhost:8000/ws --tally 127.0.0.1:9910 --speed 2
+"""
+import argparse
+import asyncio
+import mmap
+import sys
+from collections import Counter
+from datetime import datetime, time as time_of_day
+from typing import Iterator, Tuple, Optional
+
+from constants import TALLY_IDS
+from journal import MAGIC, VERSION, FILE_HEADER, RECORD_HEADER, NO_CAMERA, Kind
+
+# Time, kind, camera and payload of a record, the payload refers to the memory mapped file
+Record = Tuple[float, Kind, int, memoryview]
+TALLY_STATES = {0: "off", 1: "preview", 2: "program", 3: "preview+program"}
+
+
+def read_records(journal: memoryview) -> Iterator[Record]:
+    magic, version = FILE_HEADER.unpack_from(journal, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a journal of version {VERSION}")
+    offset = FILE_HEADER.size
+    end = len(journal)
+    while offset + RECORD_HEADER.size <= end:
+        timestamp, kind, cam, length = RECORD_HEADER.unpack_from(journal, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > end:
+            break
+        yield timestamp, Kind(kind), cam, journal[offset:offset + length]
+        offset += length
+    if offset < end:
+        print(f"Incomplete record at the end of the journal ({end - offset} bytes) ignored", file=sys.stderr)
+
+
+def parse_time(value: str, day: datetime) -> float:
+    """Timestamp of a date and time, or of a time of day on the day of the first record"""
+
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return datetime.combine(day.date(), time_of_day.fromisoformat(value)).timestamp()
+
+
+def select(records: Iterator[Record], args) -> Iterator[Record]:
+    start = end = None
+    kinds = {Kind[kind.upper()] for kind in args.kind.split(",")} if args.kind else None
+    cam = args.cam - 1 if args.cam else None
+    for record in records:
+        timestamp, kind, record_cam, _payload = record
+        if start is None:
+            day = datetime.fromtimestamp(timestamp)
+            start = parse_time(args.start, day) if args.start else 0.0
+            end = parse_time(args.end, day) if args.end else float("inf")
+        if timestamp < start:
+            continue
+        if timestamp > end:
+            # Records are in chronological order
+            break
+        if kinds is not None and kind not in kinds:
+            continue
+        # Records of all cameras (e.g. requests and disabling the relay) are part of each camera's timeline
+        if cam is not None and record_cam not in (cam, NO_CAMERA):
+            continue
+        yield record
+
+
+def describe(kind: Kind, cam: int, payload: memoryview) -> str:
+    target = "-" if cam == NO_CAMERA else f"PTZ {cam + 1}"
+    if kind == Kind.TALLY:
+        return f"{target:<7} TALLY   {TALLY_STATES.get(payload[0], payload[0])}"
+    elif kind == Kind.RELAY:
+        return f"{target:<7} RELAY   {'disabled' if cam == NO_CAMERA else 'selected'}"
+    elif kind == Kind.VISCA_COMMAND:
+        return f"{target:<7} VISCA > {payload.hex(' ')}"
+    elif kind == Kind.VISCA_REPLY:
+        # Error replies are 9x 6y ee FF
+        error = " ERROR" if len(payload) > 1 and payload[1] & 0xF0 == 0x60 else ""
+        return f"{target:<7} VISCA < {payload.hex(' ')}{error}"
+    return f"{target:<7} REQUEST {bytes(payload).decode()}"
+
+
+def print_timeline(records: Iterator[Record]):
+    previous = None
+    for timestamp, kind, cam, payload in records:
+        delta = 0.0 if previous is None else (timestamp - previous) * 1000
+        previous = timestamp
+        clock = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        print(f"{clock} {delta:+9.1f} ms  {describe(kind, cam, payload)}")
+
+
+def print_stats(records: Iterator[Record]):
+    counts = Counter()
+    errors = Counter()
+    first = last = None
+    for timestamp, kind, cam, payload in records:
+        first = timestamp if first is None else first
+        last = timestamp
+        counts[kind, cam] += 1
+        if kind == Kind.VISCA_REPLY and len(payload) > 1 and payload[1] & 0xF0 == 0x60:
+            errors[cam] += 1
+    if first is None:
+        print("No records")
+        return
+    print(f"{datetime.fromtimestamp(first)} - {datetime.fromtimestamp(last)} ({last - first:.1f} s)")
+    for (kind, cam), count in sorted(counts.items()):
+        target = "-" if cam == NO_CAMERA else f"PTZ {cam + 1}"
+        print(f"{kind.name:<14} {target:<7} {count:>9}")
+    for cam, count in sorted(errors.items()):
+        print(f"{'VISCA errors':<14} {'PTZ ' + str(cam + 1):<7} {count:>9}")
+
+
+async def drive(records: Iterator[Record], url: Optional[str], tally: Optional[str], speed: float):
+    """Send requests and tally changes with their original timing (divided by speed)"""
+
+    websocket = server = None
+    if url:
+        import websockets
+        websocket = await websockets.connect(url, max_queue=None)
+    if tally:
+        from bench.tally import SimulatedTallyServer
+        server = SimulatedTallyServer()
+        host, port = tally.rsplit(":", 1)
+        await server.start(host, int(port))
+    loop = asyncio.get_running_loop()
+    start = origin = None
+    sent = 0
+    try:
+        for timestamp, kind, cam, payload in records:
+            if kind == Kind.REQUEST and websocket is not None:
+                message = bytes(payload).decode()
+            elif kind == Kind.TALLY and server is not None:
+                message = None
+            else:
+                continue
+            if start is None:
+                start, origin = loop.time(), timestamp
+            delay = start + (timestamp - origin) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if message is not None:
+                await websocket.send(message)
+            else:
+                server.set_states({TALLY_IDS[cam]: payload[0]})
+            sent += 1
+        # Give the system time to finish the last request
+        await asyncio.sleep(1.0)
+    finally:
+        if websocket is not None:
+            await websocket.close()
+        if server is not None:
+            server.close()
+    print(f"Re-driven {sent} records")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("journal", help="journal file (JOURNAL_FILE)")
+    parser.add_argument("--start", help="first time of day (e.g. 19:30) or date and time to include")
+    parser.add_argument("--end", help="last time of day or date and time to include")
+    parser.add_argument("--cam", type=int, help="only records of this PTZ (1-based) and of all cameras")
+    parser.add_argument("--kind", help="comma separated kinds to include: " +
+                                       ",".join(kind.name.lower() for kind in Kind))
+    parser.add_argument("--stats", action="store_true", help="count records instead of printing them")
+    parser.add_argument("--drive", metavar="URL", help="send the recorded requests to this WebSocket URL")
+    parser.add_argument("--tally", metavar="HOST:PORT", help="serve the recorded tally changes at this address")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed factor for re-driving")
+    args = parser.parse_args()
+    with open(args.journal, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        journal = memoryview(mapped)
+        records = select(read_records(journal), args)
+        try:
+            if args.drive or args.tally:
+                asyncio.run(drive(records, args.drive, args.tally, args.speed))
+            elif args.stats:
+                print_stats(records)
+            else:
+                print_timeline(records)
+        except BrokenPipeError:
+            # Output piped to head etc.
+            pass
+        finally:
+            # Payloads must not refer to the mapped file any longer when it is closed
+            records.close()
+            journal.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import asyncio
+import heapq
+import logging
+from enum import IntEnum
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from constants import VISCA_TIMEOUT
+from health import CameraHealth
+from visca import CommandSocket
+
+LOG = logging.getLogger("scheduler")
+
+
+class Priority(IntEnum):
+    RECALL = 0
+    CONTROL = 1
+
+
+class Job:
+    def __init__(self, priority: Priority, seq: int, key: Optional[str], factory: Callable[[], Awaitable[Any]],
+                 timeout: float):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.factory = factory
+        self.timeout = timeout
+        self.future = asyncio.get_running_loop().create_future()
+        # Whether the caller gave up on the job while it was running
+        self.abandoned = False
+
+    def __lt__(self, other: "Job"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CameraScheduler:
+    """Executes the jobs for one camera one after another, ordered by priority.
+
+    Submitting a job with the key of a queued job replaces the latter (latest wins), its caller receives None.
+    With preempt, a running job of the same key is cancelled as well.
+    Every job has a timeout, so that a lost reply cannot block the camera. Jobs for a camera that is down fail
+    immediately, job results (including timeouts and jobs abandoned by their caller) are reported to its health.
+    """
+
+    def __init__(self, camera: CommandSocket, health: Optional[CameraHealth] = None):
+        self.camera = camera
+        self.health = health
+        self.queue: List[Job] = []
+        self.queued: Dict[str, Job] = {}
+        self.running: Optional[Job] = None
+        self.running_task: Optional[asyncio.Task] = None
+        self.counter = count()
+        self.wakeup = asyncio.Event()
+        self.worker: Optional[asyncio.Task] = None
+
+    def submit(self, priority: Priority, key: Optional[str], factory: Callable[[], Awaitable[Any]],
+               preempt=False, timeout: float = VISCA_TIMEOUT) -> asyncio.Future:
+        job = Job(priority, next(self.counter), key, factory, timeout)
+        if self.health is not None:
+            try:
+                self.health.check()
+            except Exception as e:
+                job.future.set_exception(e)
+                return job.future
+        if key is not None:
+            stale = self.queued.pop(key, None)
+            if stale is not None:
+                LOG.debug("Queued job %s for %s superseded", key, self.camera.ip)
+                self.queue.remove(stale)
+                heapq.heapify(self.queue)
+                # Keep the queue position of the superseded job, unless the new one is more urgent anyway
+                job.seq = min(job.seq, stale.seq)
+                job.priority = min(job.priority, stale.priority)
+                if not stale.future.done():
+                    stale.future.set_result(None)
+            if preempt and self.running is not None and self.running.key == key:
+                LOG.debug("Running job %s for %s cancelled", key, self.camera.ip)
+                self.running_task.cancel()
+            self.queued[key] = job
+        heapq.heappush(self.queue, job)
+        # Cancelling the caller's future (e.g. by a timeout) cancels the job as well
+        job.future.add_done_callback(lambda f: self.__abandon(job) if f.cancelled() else None)
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.__run())
+        self.wakeup.set()
+        return job.future
+
+    def __abandon(self, job: Job):
+        if self.running is job:
+            job.abandoned = True
+            self.running_task.cancel()
+
+    async def __run(self):
+        while True:
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            job = heapq.heappop(self.queue)
+            if job.key is not None:
+                del self.queued[job.key]
+            if job.future.done():
+                # Caller gave up before the job was started
+                continue
+            self.running = job
+            self.running_task = asyncio.create_task(asyncio.wait_for(job.factory(), job.timeout))
+            # Waiting instead of awaiting keeps cancellation of the job apart from cancellation of the worker
+            await asyncio.wait([self.running_task])
+            task = self.running_task
+            self.running = None
+            self.running_task = None
+            if self.health is not None and (job.abandoned or not task.cancelled()):
+                if job.abandoned or isinstance(task.exception(), (asyncio.TimeoutError, OSError)):
+                    self.health.record_failure()
+                else:
+                    # Any answer, even an error, proves the camera is reachable
+                    self.health.record_success()
+            if job.future.done():
+                continue
+            if task.cancelled():
+                # Pre-empted by a newer job of the same key
+                job.future.set_result(None)
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+
+    async def close(self):
+        for job in self.queue:
+            if not job.future.done():
+                job.future.cancel()
+        self.queue.clear()
+        self.queued.clear()
+        if self.running_task is not None:
+            self.running_task.cancel()
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
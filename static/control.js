@@ -13,6 +13,9 @@ jQuery(() => {
         const waitText = $("#wait-text");
         // Map of header elements
         const ptzHeaders = {};
+        const ptzColumns = {};
+        // Map of button rows within the columns
+        const ptzRows = {};
         // References for Bootstrap Modal for label and color
         const labelModal = $("#label-modal");
         const bsLabelModal = new bootstrap.Modal(labelModal.get(0));
@@ -32,10 +35,12 @@ jQuery(() => {
                 .append(header)
                 .append($.new("h2").text(ip))
                 .appendTo(ptzWrapper);
-            return $
+            ptzColumns[index] = col;
+            ptzRows[index] = $
                 .new("div")
                 .attr("class", "row")
                 .appendTo(col);
+            return ptzRows[index];
         };
         // Update PTZ header with tally state
         const updatePtzHeader = (index, state) => {
@@ -78,13 +83,34 @@ jQuery(() => {
                 .text(data["name"]);
             return data;
         };
-        // Send over WebSocket
-        const wsSend = (eventName, data) => {
+        // Callbacks of requests awaiting their result, by request ID
+        const pendingRequests = {};
+        let nextRequestId = 1;
+        // Send over WebSocket, onSuccess is called once the server reports the request as successful
+        const wsSend = (eventName, data, onSuccess) => {
+            const requestId = nextRequestId++;
+            pendingRequests[requestId] = {"event": eventName, "onSuccess": onSuccess};
             webSocket.send(JSON.stringify({
+                "id": requestId,
                 "event": eventName,
                 "data": data
             }));
         };
+        const handleResult = (result) => {
+            const request = pendingRequests[result["id"]];
+            if (request === undefined) {
+                return;
+            }
+            delete pendingRequests[result["id"]];
+            if (result["status"] === "success") {
+                if (request.onSuccess !== undefined) {
+                    request.onSuccess();
+                }
+            } else {
+                console.error(`Request ${request.event} failed (${result["status"]})`, result["error"]);
+                flashBackground("pulse-red");
+            }
+        };
         const sendOnOff = (value, event) => {
             if (value === "on") {
                 wsSend(event, true);
@@ -107,8 +133,64 @@ jQuery(() => {
             wsSend("save_pos", {
                 "cam": data["cam"],
                 "pos": data["pos"]
+            }, () => flashBackground("pulse-green"));
+        };
+        // Mark cameras that do not answer health probes, commands to a camera that is down fail immediately
+        const updateHealth = (cam, state) => {
+            const col = ptzColumns[cam];
+            if (col !== undefined) {
+                col.removeClass("health-degraded health-down");
+                if (state !== "up") {
+                    col.addClass("health-" + state);
+                }
+            }
+        };
+        // Apply a changed configuration: Remove cameras and buttons beyond it, add the new ones
+        const updateConfig = (data) => {
+            Object.keys(ptzColumns).map(Number).filter((cam) => cam >= data["num_cameras"]).forEach((cam) => {
+                ptzColumns[cam].remove();
+                delete ptzColumns[cam];
+                delete ptzHeaders[cam];
+                delete ptzRows[cam];
+            });
+            ptzWrapper
+                .find(".ptz-button")
+                .filter((_index, element) => $(element).data("pos") >= data["num_buttons"])
+                .parent()
+                .remove();
+            Object.entries(ptzColumns).forEach(([cam, col]) => col.children("h2").text(data["camera_ips"][cam]));
+            data["added"].forEach((row) => {
+                const cam = row["cam"];
+                if (ptzRows[cam] === undefined) {
+                    makePtzCol(cam, data["camera_ips"][cam], data["tally_states"][cam]);
+                }
+                ptzRows[cam].append(makePtzButton(row));
+            });
+            Object.keys(ptzHeaders).forEach((cam) => updatePtzHeader(cam, data["tally_states"][cam]));
+            updateScenes(data["scenes"]);
+        };
+        // Mark cameras while they move, e.g. until a recall has finished
+        const updateCameraState = (cam, state) => {
+            const col = ptzColumns[cam];
+            if (col !== undefined) {
+                col.toggleClass("camera-moving", state !== null && state["moving"]);
+            }
+        };
+        // Mark tally states as outdated while the server has no tally connection
+        const updateTallyStale = (stale) => {
+            ptzWrapper.toggleClass("tally-stale", stale);
+        };
+        // Scene buttons, saved scenes are highlighted
+        const sceneGroup = $("#button-scene-group");
+        const updateScenes = (scenes) => {
+            sceneGroup.empty();
+            scenes.forEach((saved, scene) => {
+                $.new("button")
+                    .attr("class", "btn btn-lg shadow-none " + (saved ? "btn-primary" : "btn-secondary"))
+                    .data({"scene": scene, "saved": saved})
+                    .text(scene + 1)
+                    .appendTo(sceneGroup);
             });
-            flashBackground("pulse-green");
         };
         const updateOnAirChangeButtons = (allowOnAirChange) => {
             if (allowOnAirChange) {
@@ -118,12 +200,85 @@ jQuery(() => {
             }
         };
 
+        // Clear labels and colors of all buttons
+        const clearButtons = () => {
+            ptzWrapper.find(".ptz-button").each((_index, element) => {
+                updateButton({
+                    "name": "",
+                    "btn_class": "btn-secondary"
+                }, $(element));
+            });
+        };
+        // Decode compact binary frames (opcode, sequence number, payload), see protocol.py
+        const BINARY_EVENTS = {
+            1: (view) => {  // update_tally
+                const changes = [];
+                for (let i = 5; i < view.byteLength; i += 2) {
+                    changes.push([view.getUint8(i), view.getUint8(i + 1)]);
+                }
+                return changes;
+            },
+            2: () => null,  // clear_buttons
+            3: (view) => view.getUint8(5) !== 0,  // update_on_air_change
+            4: (view) => {  // update_camera_state
+                const flags = view.getUint8(6);
+                return [view.getUint8(5), (flags & 0x1) === 0 ? null : {
+                    "autofocus": (flags & 0x2) !== 0,
+                    "moving": (flags & 0x4) !== 0,
+                    "pan": view.getInt16(7),
+                    "tilt": view.getInt16(9),
+                    "zoom": view.getUint16(11),
+                    "focus": view.getUint16(13)
+                }];
+            }
+        };
+        const BINARY_EVENT_NAMES = {
+            1: "update_tally",
+            2: "clear_buttons",
+            3: "update_on_air_change",
+            4: "update_camera_state"
+        };
+        const decodeMessage = (raw) => {
+            if (!(raw instanceof ArrayBuffer)) {
+                return JSON.parse(raw);
+            }
+            const view = new DataView(raw);
+            const opcode = view.getUint8(0);
+            return {
+                "event": BINARY_EVENT_NAMES[opcode],
+                "seq": view.getUint32(1),
+                "data": BINARY_EVENTS[opcode](view)
+            };
+        };
+        // Sequence number of the last state change applied, null while the state is not known
+        let stateSeq = null;
+        // Server epoch the sequence numbers belong to
+        let stateEpoch = null;
+
         // WebSocket message handling
         const wsMessageHandler = (message) => {
-            const messageData = JSON.parse(message.data);
+            const messageData = decodeMessage(message.data);
             const event = messageData.event;
             const data = messageData.data;
-            console.log(event, data);
+            console.log(event, messageData.seq, data);
+            if (event === "result") {
+                // Result of a request, not a state change
+                handleResult(data);
+                return;
+            }
+            if (event !== "init" && event !== "resume") {
+                if (stateSeq === null) {
+                    // Initial state not received yet
+                    return;
+                }
+                if (messageData.seq !== stateSeq + 1) {
+                    console.log(`Missed state change (expected ${stateSeq + 1}), requesting full state...`);
+                    stateSeq = null;
+                    wsSend("resync", null);
+                    return;
+                }
+            }
+            stateSeq = messageData.seq;
             switch (event) {
                 case "init":
                     const cameraIps = data["camera_ips"];
@@ -131,7 +286,9 @@ jQuery(() => {
                     const tallyStates = data["tally_states"];
                     let cam = null;
                     let col = null;
+                    stateEpoch = data["epoch"];
                     waitText.hide();
+                    ptzWrapper.removeClass("disconnected");
                     // Remove all columns before repaint
                     waitText.nextAll().remove();
                     posData.forEach((row) => {
@@ -142,16 +299,44 @@ jQuery(() => {
                         col.append(makePtzButton(row));
                     });
                     updateOnAirChangeButtons(data["on_air_change_allowed"]);
+                    updateScenes(data["scenes"]);
+                    updateTallyStale(data["tally_stale"]);
+                    data["camera_health"].forEach((state, cam) => updateHealth(cam, state));
+                    data["camera_states"].forEach((state, cam) => updateCameraState(cam, state));
+                    break;
+                case "resume":
+                    // Missed state changes (if any) will follow
+                    waitText.hide();
+                    ptzWrapper.removeClass("disconnected");
                     break;
                 case "update_button":
                     updateButton(data);
                     break;
+                case "clear_buttons":
+                    clearButtons();
+                    break;
                 case "update_tally":
-                    data.forEach((state, index) => updatePtzHeader(index, state));
+                    // Pairs of camera and state
+                    data.forEach(([cam, state]) => updatePtzHeader(cam, state));
+                    break;
+                case "update_tally_stale":
+                    updateTallyStale(data);
                     break;
                 case "update_on_air_change":
                     updateOnAirChangeButtons(data);
                     break;
+                case "update_scenes":
+                    updateScenes(data);
+                    break;
+                case "update_health":
+                    updateHealth(data[0], data[1]);
+                    break;
+                case "update_config":
+                    updateConfig(data);
+                    break;
+                case "update_camera_state":
+                    updateCameraState(data[0], data[1]);
+                    break;
                 default:
                     console.log("Unknown event: " + event, data);
             }
@@ -159,12 +344,21 @@ jQuery(() => {
         let wsTimeout = null;
         const connectWebSocket = () => {
             wsTimeout = null;
-            webSocket = new WebSocket("ws://" + window.location.hostname + "/ws");
+            let url = "ws://" + window.location.hostname + "/ws?binary=1";
+            if (stateSeq !== null) {
+                // Ask for the missed state changes only, instead of the full state
+                url += `&epoch=${stateEpoch}&since=${stateSeq}`;
+            }
+            webSocket = new WebSocket(url);
+            webSocket.binaryType = "arraybuffer";
             webSocket.onmessage = wsMessageHandler;
             const handleReconnect = (message, timeout) => {
                 if (wsTimeout === null) {
+                    // Keep the buttons until reconnected, but mark them as outdated
                     waitText.show();
-                    waitText.nextAll().remove();
+                    ptzWrapper.addClass("disconnected");
+                    // Results of pending requests are lost with the connection
+                    Object.keys(pendingRequests).forEach((requestId) => delete pendingRequests[requestId]);
                     console.log(message);
                     wsTimeout = setTimeout(connectWebSocket, timeout);
                 }
@@ -208,6 +402,19 @@ jQuery(() => {
         $("#button-mode-group").on("change", "input", (event) => {
             buttonMode = event.target.value;
         });
+        // Event handler for scenes, recalled in recall mode and saved in label mode
+        sceneGroup.on("click", "button", (event) => {
+            const data = $(event.target).data();
+            if (buttonMode === LABEL) {
+                if (confirm(`Save the positions of all PTZ cameras as scene ${data["scene"] + 1}?`)) {
+                    wsSend("save_scene", data["scene"], () => flashBackground("pulse-green"));
+                }
+            } else if (data["saved"]) {
+                wsSend("recall_scene", data["scene"]);
+            } else {
+                flashBackground("pulse-red", 300);
+            }
+        });
         // Menu wrapper buttons active state fix
         $("#menu-wrapper").on("click", "button", (event) => {
             $(event.target).blur();
@@ -1,9 +1,14 @@
 import asyncio
 import logging
 from asyncio import StreamReader, StreamWriter, CancelledError, Task
-from typing import Awaitable, Callable, List, Optional
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Dict, Tuple
 
-from constants import TALLY_IDS, TALLY_HOST, TALLY_PORT, TALLY_KEEPALIVE_FREQUENCY
+from constants import TALLY_SOURCES, TALLY_KEEPALIVE_FREQUENCY, TALLY_KEEPALIVE_TIMEOUT, TALLY_CONNECT_TIMEOUT, \
+    TALLY_RECONNECT_MAX_DELAY
+from journal import JOURNAL, Kind
+from logs import NO_RATE_LIMIT
+from metrics import TALLY_CHANGES, TALLY_PROPAGATION_SECONDS
 
 LOG = logging.getLogger("tally")
 watch_task: Optional[Task] = None
@@ -17,10 +22,11 @@ async def stop_watcher():
         pass
 
 
-def watch_tallies(tally_notify: Callable[[int, int], Awaitable[None]]):
+def watch_tallies(tally_ids: List[int], tally_notify: Callable[[Dict[int, int]], Awaitable[None]],
+                  stale_notify: Callable[[bool], Awaitable[None]]):
     global watch_task
     # Create and schedule tally watcher clients
-    watch_task = asyncio.create_task(watch(TALLY_IDS, tally_notify, TALLY_HOST, TALLY_PORT))
+    watch_task = asyncio.create_task(TallyWatcher(tally_ids, tally_notify, stale_notify, TALLY_SOURCES).run())
 
 
 async def send_keepalive_messages(writer: StreamWriter):
@@ -32,8 +38,7 @@ async def send_keepalive_messages(writer: StreamWriter):
     except CancelledError:
         LOG.debug("Keepalive task has been cancelled")
     except Exception as e:
-        LOG.error("Error whilst sending keep-alive message")
-        logging.exception(e)
+        LOG.error("Error whilst sending keep-alive message", exc_info=e)
 
 
 async def connect(tally_ids: List[int], host: str, port: int) -> (StreamReader, StreamWriter):
@@ -51,52 +56,191 @@ async def connect(tally_ids: List[int], host: str, port: int) -> (StreamReader,
     return reader, writer
 
 
-async def watch(tally_ids: List[int], callback: Callable[[int, int], Awaitable[None]], host: str, port: int):
-    # Start with a 1-second reconnect delay on first error (see doubling below)
-    reconnect_delay = 0.5
-    tally_map = {tally_cam: cam for cam, tally_cam in enumerate(TALLY_IDS)}
-    last_states = [0] * len(tally_ids)
-    LOG.info(f"Connecting to tally state monitoring for devices {tally_ids}")
-    writer = None
-    keep_alive_task = None
-    while True:
+class TallyConnection:
+    """Connection to one tally source, tracking the states it reports and detecting a dead peer"""
+
+    def __init__(self, source: Tuple[str, int], reader: StreamReader, writer: StreamWriter,
+                 tally_map: Dict[int, int], on_burst: Callable[["TallyConnection", float], Awaitable[None]]):
+        self.source = source
+        self.reader = reader
+        self.writer = writer
+        self.tally_map = tally_map
+        self.on_burst = on_burst
+        self.states: Dict[int, int] = {}
+        self.keep_alive_task = asyncio.create_task(send_keepalive_messages(writer))
+        self.read_task = asyncio.create_task(self.__read())
+
+    def __str__(self):
+        return f"{self.source[0]}:{self.source[1]}"
+
+    @property
+    def alive(self) -> bool:
+        return not self.read_task.done()
+
+    async def __read(self):
         try:
-            if reconnect_delay > 0.5:
-                LOG.error(f"Error, try reconnect after {reconnect_delay} s...")
-                await asyncio.sleep(reconnect_delay)
-            reader, writer = await connect(tally_ids, host, port)
-            keep_alive_task = asyncio.create_task(send_keepalive_messages(writer))
+            # Odd byte of an incomplete message, completed by the next read
+            remainder = b''
             while True:
-                state_bytes = await reader.readexactly(2)
-                # Handle keep-alive
-                if state_bytes == b'\xff\xff':
-                    continue
-                # Upon success, reset reconnect delay to initial value
+                # Take everything buffered, all changes of a burst (e.g. a transition) are applied at once
+                # Without any data (including keep-alive answers) for a while, the peer is considered dead
+                data = remainder + await asyncio.wait_for(self.reader.read(4096), TALLY_KEEPALIVE_TIMEOUT)
+                if len(data) == len(remainder):
+                    raise ConnectionError("Connection closed")
+                start = perf_counter()
+                end = len(data) & ~1
+                remainder = data[end:]
+                changed = False
+                for i in range(0, end, 2):
+                    # Extract bytes: First tally cam ID, second state value
+                    tally_cam, state = data[i], data[i + 1]
+                    # Handle keep-alive
+                    if tally_cam == 0xFF and state == 0xFF:
+                        continue
+                    cam = self.tally_map[tally_cam]
+                    if state != self.states.get(cam):
+                        self.states[cam] = state
+                        changed = True
+                if changed:
+                    await self.on_burst(self, start)
+        except CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            LOG.error("Tally source %s does not answer", self)
+        except Exception as e:
+            LOG.error("Tally source %s failed", self, exc_info=e)
+
+    def close(self):
+        self.read_task.cancel()
+        self.keep_alive_task.cancel()
+        # Close connection without awaiting result
+        self.writer.close()
+
+
+class TallyWatcher:
+    """Watches tally states via an active connection, with a pre-warmed standby connection for instant failover.
+
+    Connections are raced across all sources, the first one established wins. The standby connects to another
+    source if available, otherwise to the same one.
+    """
+
+    def __init__(self, tally_ids: List[int], callback: Callable[[Dict[int, int]], Awaitable[None]],
+                 stale_callback: Callable[[bool], Awaitable[None]], sources: List[Tuple[str, int]]):
+        self.tally_ids = tally_ids
+        self.callback = callback
+        self.stale_callback = stale_callback
+        self.sources = sources
+        self.tally_map = {tally_cam: cam for cam, tally_cam in enumerate(tally_ids)}
+        # States passed on to the callback
+        self.last_states = [0] * len(tally_ids)
+        self.stale = False
+        self.active: Optional[TallyConnection] = None
+        self.standby: Optional[TallyConnection] = None
+        self.standby_task: Optional[Task] = None
+
+    async def __connect(self, source: Tuple[str, int]) -> TallyConnection:
+        reader, writer = await asyncio.wait_for(connect(self.tally_ids, *source), TALLY_CONNECT_TIMEOUT)
+        return TallyConnection(source, reader, writer, self.tally_map, self.__on_burst)
+
+    async def __race(self, sources: List[Tuple[str, int]]) -> Optional[TallyConnection]:
+        """Connect to all sources concurrently, the first connection established is returned, the others closed"""
+
+        pending = {asyncio.create_task(self.__connect(source)) for source in sources}
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        LOG.warning("Cannot connect to tally source: %r", task.exception())
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result().close()
+        finally:
+            for task in pending:
+                task.cancel()
+        return winner
+
+    async def __keep_standby(self):
+        reconnect_delay = 0.5
+        while True:
+            active_source = self.active.source if self.active is not None else None
+            others = [source for source in self.sources if source != active_source] or self.sources
+            standby = await self.__race(others)
+            if standby is not None:
+                LOG.info("Standby tally connection to %s established", standby)
+                self.standby = standby
+                # Waiting instead of awaiting, cancellation upon failover must not affect the connection
+                await asyncio.wait([standby.read_task])
+                self.standby = None
+                standby.close()
                 reconnect_delay = 0.5
-                # Extract bytes: First tally cam ID, second state value
-                tally_cam, state = state_bytes
-                cam = tally_map[tally_cam]
-                if state != last_states[cam]:
-                    LOG.info(f"Switched tally state {last_states[cam]} => {state} for PTZ {cam + 1}")
-                    last_states[cam] = state
-                    await callback(cam, state)
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, TALLY_RECONNECT_MAX_DELAY)
+
+    async def __on_burst(self, connection: TallyConnection, start: float):
+        if connection is self.active:
+            await self.__publish(connection, start)
+
+    async def __publish(self, connection: TallyConnection, start: float):
+        changes = {}
+        for cam, state in connection.states.items():
+            if state != self.last_states[cam]:
+                LOG.info("Switched tally state %d => %d for PTZ %d", self.last_states[cam], state, cam + 1,
+                         extra=NO_RATE_LIMIT)
+                self.last_states[cam] = state
+                changes[cam] = state
+                JOURNAL.record(Kind.TALLY, cam, bytes((state,)))
+                TALLY_CHANGES.inc(cam)
+        if changes:
+            await self.callback(changes)
+            TALLY_PROPAGATION_SECONDS.observe(perf_counter() - start)
+
+    async def __set_stale(self, stale: bool):
+        if stale != self.stale:
+            self.stale = stale
+            if stale:
+                LOG.error("Tally states are stale")
+            else:
+                LOG.info("Tally states are up to date")
+            await self.stale_callback(stale)
+
+    async def run(self):
+        LOG.info("Connecting to tally state monitoring for devices %s at %s", self.tally_ids, self.sources)
+        reconnect_delay = 0.5
+        try:
+            while True:
+                if self.standby is not None and self.standby.alive:
+                    # Failover to the pre-warmed standby connection
+                    LOG.warning("Tally failover to %s", self.standby)
+                    self.active = self.standby
+                    self.standby = None
+                    self.standby_task.cancel()
+                    self.standby_task = None
                 else:
-                    LOG.debug(f"Received unchanged tally state {state} for PTZ {cam + 1}")
+                    self.active = await self.__race(self.sources)
+                if self.active is None:
+                    await self.__set_stale(True)
+                    LOG.error("Error, try reconnect after %s s...", reconnect_delay)
+                    await asyncio.sleep(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * 2, TALLY_RECONNECT_MAX_DELAY)
+                    continue
+                reconnect_delay = 0.5
+                LOG.info("Active tally connection to %s", self.active)
+                # Pass on whatever changed while no connection was active
+                await self.__publish(self.active, perf_counter())
+                await self.__set_stale(False)
+                if self.standby_task is None:
+                    self.standby_task = asyncio.create_task(self.__keep_standby())
+                await self.active.read_task
+                self.active.close()
+                self.active = None
         except CancelledError:
-            logging.debug(f"Tally watcher for devices {tally_ids} cancelled")
-            # Exit task
-            return
-        except Exception as e:
-            logging.exception(e)
-            # Increase delay exponentially
-            reconnect_delay = min(reconnect_delay * 2, 20)
+            LOG.debug("Tally watcher for devices %s cancelled", self.tally_ids)
         finally:
-            try:
-                if writer is not None:
-                    # Close connection without awaiting result
-                    writer.close()
-                if keep_alive_task is not None:
-                    # Cancel keepalive message sending
-                    keep_alive_task.cancel()
-            except:
-                pass
+            for connection in (self.active, self.standby):
+                if connection is not None:
+                    connection.close()
+            if self.standby_task is not None:
+                self.standby_task.cancel()
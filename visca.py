@@ -1,11 +1,16 @@
 import asyncio
 import logging
+from collections import deque
 from enum import Enum
-from typing import Union
+from functools import partial
+from itertools import chain
+from time import perf_counter
+from typing import Union, Optional, Deque, Dict, Tuple, NamedTuple
 
-import asyncio_dgram
-
-from constants import VISCA_MEMORY_SPEED
+from constants import VISCA_MEMORY_SPEED, VISCA_TIMEOUT, VISCA_COMMAND_BUFFERS, RECALL_TIMEOUT
+from journal import JOURNAL, Kind, NO_CAMERA
+from logs import HexBytes
+from metrics import VISCA_REQUEST_SECONDS, VISCA_REQUESTS, RECALL_SECONDS
 
 LOG = logging.getLogger("visca")
 
@@ -20,7 +25,17 @@ class AnswerException(Exception):
     pass
 
 
+class CameraState(NamedTuple):
+    pan: int
+    tilt: int
+    zoom: int
+    focus: int
+    autofocus: State
+
+
 def check_answer(expected: list, received: list):
+    if len(expected) != len(received):
+        raise AnswerException(f"Answer has unexpected length, expected {str(expected)}, received {str(received)}")
     for exp, comp in zip(expected, received):
         if exp is not None and exp != comp:
             raise AnswerException(f"Answer has unexpected format, expected {str(expected)}, received {str(received)}")
@@ -31,14 +46,13 @@ def convert_int_to_half_bytes(integer: int) -> list:
 
     result = []
     i = integer
-    while i > 16:
+    while i >= 16:
         result.append(i % 16)
         i //= 16
     result.append(i)
     while len(result) < 4:
         result.append(0)
     result.reverse()
-    LOG.debug(f"Convert: {integer} -> {result}")
     return result
 
 
@@ -48,122 +62,405 @@ def convert_half_bytes_int(half_bytes: list) -> int:
     result = 0
     for b in half_bytes:
         if b > 15:
-            raise Exception(f"Invalid byte value {b}, only low half must be used!")
+            raise AnswerException(f"Invalid byte value {b}, only low half must be used!")
         result = result * 16 + b
-    LOG.debug(f"Convert: {half_bytes} -> {result}")
     return result
 
 
+class ReplyType(Enum):
+    ACK = 0x40
+    COMPLETION = 0x50
+    ERROR = 0x60
+
+
+class ViscaError(AnswerException):
+    MESSAGES = {
+        0x01: "Message length error",
+        0x02: "Syntax error",
+        0x03: "Command buffer full",
+        0x04: "Command cancelled",
+        0x05: "No socket",
+        0x41: "Command not executable"
+    }
+
+    def __init__(self, code: int):
+        super().__init__(f"{self.MESSAGES.get(code, 'Unknown error')} (0x{code:02x})")
+        self.code = code
+
+
+def parse_reply(data: bytes) -> Tuple[ReplyType, int]:
+    """Decode type and socket number of a camera reply, the payload stays in place"""
+
+    if len(data) < 3 or data[0] & 0x8F != 0x80 or data[-1] != 0xFF:
+        raise AnswerException(f"Malformed answer {data.hex(' ')}")
+    try:
+        return ReplyType(data[1] & 0xF0), data[1] & 0x0F
+    except ValueError:
+        raise AnswerException(f"Unknown answer type {data.hex(' ')}")
+
+
+class PendingRequest:
+    """Request waiting for its reply, it fails with a timeout if there is none by its deadline"""
+
+    def __init__(self, is_inq: bool, reply_length: Optional[int] = None, timeout: float = VISCA_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        self.future = loop.create_future()
+        self.is_inq = is_inq
+        # Length of the answer to an inquiry, None if unknown
+        self.reply_length = reply_length
+        self.deadline = loop.time() + timeout
+        timer = loop.call_at(self.deadline, self.__expire)
+        self.future.add_done_callback(lambda _f: timer.cancel())
+
+    def __expire(self):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError())
+
+
+class ViscaProtocol(asyncio.DatagramProtocol):
+    """Long-lived datagram endpoint of one camera, resolving each request from its own reply.
+
+    Commands are acknowledged in the order they were sent and bound to one of the camera's command buffers
+    (socket 1 or 2) by their ACK, their completion or error names that socket. Inquiries are answered in order, an
+    answer goes to the oldest inquiry expecting an answer of its length, until the deadline of that inquiry.
+    """
+
+    def __init__(self, cam: int = NO_CAMERA):
+        self.cam = cam
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Commands sent, but not yet acknowledged, and inquiries sent, but not yet answered
+        self.unacked: Deque[PendingRequest] = deque()
+        self.inquiries: Deque[PendingRequest] = deque()
+        # Acknowledged commands, by socket number
+        self.sockets: Dict[int, PendingRequest] = {}
+        # The camera only has two command buffers, further commands would be rejected
+        self.buffers = asyncio.Semaphore(VISCA_COMMAND_BUFFERS)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for request in chain(self.unacked, self.inquiries, self.sockets.values()):
+            if not request.future.done():
+                request.future.set_exception(ConnectionError("VISCA transport closed"))
+        self.unacked.clear()
+        self.inquiries.clear()
+        self.sockets.clear()
+
+    def error_received(self, exc):
+        LOG.error("Error in VISCA transport", exc_info=exc)
+
+    def __purge(self, queue: Deque[PendingRequest]):
+        """Forget requests whose reply is overdue (expired or abandoned), it has most likely been lost"""
+
+        now = asyncio.get_running_loop().time()
+        while queue and queue[0].future.done() and queue[0].deadline < now:
+            queue.popleft()
+
+    def __match_inquiry(self, length: int) -> Optional[PendingRequest]:
+        """Take the oldest inquiry expecting an answer of the given length.
+
+        Inquiries abandoned by their caller still take their (late) answer, until their deadline. Since inquiries are
+        answered in order, those sent before the match have lost their answer, waiting ones fail.
+        """
+
+        self.__purge(self.inquiries)
+        for index, request in enumerate(self.inquiries):
+            if request.reply_length in (None, length):
+                break
+        else:
+            return None
+        for _ in range(index):
+            skipped = self.inquiries.popleft()
+            if not skipped.future.done():
+                skipped.future.set_exception(AnswerException("Answer to inquiry lost"))
+        return self.inquiries.popleft()
+
+    def __oldest_unanswered(self) -> Optional[PendingRequest]:
+        self.__purge(self.unacked)
+        self.__purge(self.inquiries)
+        if self.unacked and self.inquiries:
+            return min(self.unacked[0], self.inquiries[0], key=lambda r: r.deadline)
+        elif self.unacked:
+            return self.unacked[0]
+        elif self.inquiries:
+            return self.inquiries[0]
+        return None
+
+    def datagram_received(self, data, addr):
+        LOG.debug("Answer received: %s", HexBytes(data))
+        JOURNAL.record(Kind.VISCA_REPLY, self.cam, data)
+        try:
+            reply_type, socket = parse_reply(data)
+        except AnswerException as e:
+            LOG.warning("%s", e)
+            return
+        if reply_type == ReplyType.ACK:
+            self.__purge(self.unacked)
+            if not self.unacked:
+                LOG.warning("Discarding unexpected ACK from %s: %s", addr, HexBytes(data))
+                return
+            self.sockets[socket] = self.unacked.popleft()
+        elif reply_type == ReplyType.COMPLETION:
+            if socket == 0:
+                # Inquiry answer
+                request = self.__match_inquiry(len(data))
+                if request is None:
+                    LOG.warning("Discarding unexpected inquiry answer from %s: %s", addr, HexBytes(data))
+                    return
+            else:
+                request = self.sockets.pop(socket, None)
+                if request is None:
+                    LOG.warning("Discarding completion for idle socket %d: %s", socket, HexBytes(data))
+                    return
+            if not request.future.done():
+                request.future.set_result(list(data))
+        else:
+            # Errors name the socket of an acknowledged command, otherwise they refer to the oldest request
+            request = self.sockets.pop(socket, None)
+            if request is None:
+                request = self.__oldest_unanswered()
+                if request is None:
+                    LOG.warning("Discarding unexpected error from %s: %s", addr, HexBytes(data))
+                    return
+                (self.inquiries if request.is_inq else self.unacked).remove(request)
+            if not request.future.done():
+                request.future.set_exception(ViscaError(data[2]))
+
+    async def send(self, command_bytes: bytes, is_inq: bool, timeout: float = VISCA_TIMEOUT) -> asyncio.Future:
+        if not is_inq:
+            await self.buffers.acquire()
+        request = PendingRequest(is_inq, INQUIRY_REPLY_LENGTHS.get(command_bytes) if is_inq else None, timeout)
+        if is_inq:
+            self.inquiries.append(request)
+        else:
+            # Free the buffer once the command is done, no matter how
+            request.future.add_done_callback(lambda _f: self.buffers.release())
+            self.unacked.append(request)
+        self.transport.sendto(command_bytes)
+        JOURNAL.record(Kind.VISCA_COMMAND, self.cam, command_bytes)
+        LOG.debug("Command sent: %s", HexBytes(command_bytes))
+        return request.future
+
+
+# Commands without parameters, encoded once
+INQ_POWER = bytes([0x81, 0x09, 0x04, 0x00, 0xFF])
+INQ_FOCUS = bytes([0x81, 0x09, 0x04, 0x48, 0xFF])
+INQ_FOCUS_AF_MODE = bytes([0x81, 0x09, 0x04, 0x38, 0xFF])
+INQ_ZOOM = bytes([0x81, 0x09, 0x04, 0x47, 0xFF])
+INQ_PAN_TILT = bytes([0x81, 0x09, 0x06, 0x12, 0xFF])
+# Length of the answers to the inquiries, answers of another length belong to another inquiry
+INQUIRY_REPLY_LENGTHS = {INQ_POWER: 4, INQ_FOCUS: 7, INQ_FOCUS_AF_MODE: 4, INQ_ZOOM: 7, INQ_PAN_TILT: 11}
+AUTOFOCUS_ON = bytes([0x81, 0x01, 0x04, 0x38, State.ON.value, 0xFF])
+FOCUS_LOCK = {state: bytes([0x81, 0x0A, 0x04, 0x68, state.value, 0xFF]) for state in (State.ON, State.OFF)}
+SET_MEMORY_SPEED = bytes([0x81, 0x01, 0x06, 0x01, VISCA_MEMORY_SPEED, 0xFF])
+
+
+def parse_pan_tilt(answer: list) -> Tuple[int, int]:
+    """Pan and tilt position of an answer to INQ_PAN_TILT, both are signed 16-bit values"""
+
+    check_answer([0x90, 0x50, None, None, None, None, None, None, None, None, 0xFF], answer)
+    pan, tilt = convert_half_bytes_int(answer[2:6]), convert_half_bytes_int(answer[6:10])
+    return pan - 0x10000 if pan & 0x8000 else pan, tilt - 0x10000 if tilt & 0x8000 else tilt
+
+
+def encode_focus_direct(focus: int) -> bytes:
+    if not 0 <= focus <= 1770:
+        raise Exception(f"Invalid focus value {focus}.")
+    return bytes([0x81, 0x01, 0x04, 0x48] + convert_int_to_half_bytes(focus) + [0xFF])
+
+
+class RecallMacro:
+    """Command bytes of a recall of one position with its focus value, compiled once and reused.
+
+    Positions without a saved focus value (-1, e.g. presets saved on the camera) are recalled without applying focus.
+    """
+
+    def __init__(self, pos: int, focus: int):
+        if not 0 <= pos <= 127:
+            raise Exception(f"Invalid position {pos}.")
+        self.pos = pos
+        self.focus = focus
+        self.memory_recall = bytes([0x81, 0x01, 0x04, 0x3F, 0x02, pos, 0xFF])
+        self.focus_direct = encode_focus_direct(focus) if focus != -1 else None
+
+
 class CommandSocket:
-    def __init__(self, ip: str, tcp_port: int):
+    def __init__(self, ip: str, udp_port: int, cam: int = NO_CAMERA):
         self.ip = ip
-        self.port = tcp_port
-        self.recall_task = None
+        self.port = udp_port
+        # Camera number in the journal
+        self.cam = cam
         self.ephemeral_autofocus = False
-
-    async def __exec(self, command: list, is_inq=False) -> Union[list, None]:
-        sock = None
+        self.protocol: Optional[ViscaProtocol] = None
+        self.connect_lock = asyncio.Lock()
+        # Compiled recalls by position, replaced when the focus value of the position changes
+        self.recall_macros: Dict[int, RecallMacro] = {}
+
+    async def __connect(self) -> ViscaProtocol:
+        async with self.connect_lock:
+            if self.protocol is None or self.protocol.transport.is_closing():
+                loop = asyncio.get_running_loop()
+                _transport, self.protocol = await loop.create_datagram_endpoint(
+                    partial(ViscaProtocol, self.cam),
+                    remote_addr=(self.ip, self.port)
+                )
+                LOG.debug("VISCA endpoint for %s:%d opened", self.ip, self.port)
+            return self.protocol
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+
+    def __record(self, start: float, is_inq: bool, future: asyncio.Future):
+        if future.cancelled():
+            # Mostly timeouts
+            VISCA_REQUESTS.inc(self.ip, "abandoned")
+        elif isinstance(future.exception(), AnswerException):
+            VISCA_REQUESTS.inc(self.ip, "error")
+        elif future.exception() is None:
+            VISCA_REQUESTS.inc(self.ip, "success")
+            VISCA_REQUEST_SECONDS.observe(perf_counter() - start, self.ip, "inquiry" if is_inq else "command")
+
+    async def __send(self, command: bytes, is_inq=False, timeout: float = VISCA_TIMEOUT) -> asyncio.Future:
+        """Send a request as soon as a command buffer is available, returns the future of its answer.
+
+        The request fails if there is no answer within timeout, commands only complete once the camera is done.
+        """
+
+        protocol = self.protocol
+        if protocol is None or protocol.transport.is_closing():
+            protocol = await self.__connect()
+        future = await protocol.send(command, is_inq, timeout)
+        future.add_done_callback(partial(self.__record, perf_counter(), is_inq))
+        return future
+
+    async def __exec(self, command: bytes, is_inq=False, timeout: float = VISCA_TIMEOUT) -> Union[list, None]:
+        result = await (await self.__send(command, is_inq, timeout))
+        if is_inq:
+            return result
+
+    async def __exec_pipelined(self, *commands: bytes, is_inq=False) -> list:
+        """Execute independent commands without waiting for one to complete before sending the next.
+
+        The camera executes commands in its command buffers independently, so their order is not guaranteed. Only
+        the number of command buffers limits the pipeline.
+        """
+
+        futures = []
         try:
-            sock = await asyncio_dgram.connect((self.ip, self.port))
-            command_bytes = bytes(command)
-            await sock.send(command_bytes)
-            LOG.debug(f"Command sent: {command_bytes.hex(' ')}")
-            if is_inq:
-                result, _remote_address = await sock.recv()
-                LOG.debug(f"Answer received: {result.hex(' ')}")
-                return list(result)
-            else:
-                for _ in range(2):
-                    result, _remote_address = await sock.recv()
-                    LOG.debug(f"Answer received: {result.hex(' ')}")
-        finally:
-            if sock:
-                sock.close()
+            for command in commands:
+                futures.append(await self.__send(command, is_inq))
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
 
     async def set_power(self, state: State):
-        LOG.debug(f"Set power state: {state}")
-        await self.__exec([0x81, 0x01, 0x04, 0x00, state.value, 0xFF])
+        LOG.debug("Set power state: %s", state)
+        await self.__exec(bytes([0x81, 0x01, 0x04, 0x00, state.value, 0xFF]))
 
     async def inq_power(self) -> State:
-        result = await self.__exec([0x81, 0x09, 0x04, 0x00, 0xFF], True)
+        result = await self.__exec(INQ_POWER, True)
         check_answer([0x90, 0x50, None, 0xFF], result)
         return State(result[2])
 
     async def set_iris_direct(self, iris: int):
         if not 0 <= iris <= 255:
             raise Exception(f"Invalid iris value {iris}.")
-        await self.__exec([0x81, 0x01, 0x04, 0x4B] + convert_int_to_half_bytes(iris) + [0xFF])
+        await self.__exec(bytes([0x81, 0x01, 0x04, 0x4B] + convert_int_to_half_bytes(iris) + [0xFF]))
 
     async def focus_direct(self, focus: int):
-        LOG.debug(f"Set focus: {focus}")
-        if not 0 <= focus <= 1770:
-            raise Exception(f"Invalid focus value {focus}.")
-        await self.__exec([0x81, 0x01, 0x04, 0x48] + convert_int_to_half_bytes(focus) + [0xFF])
+        LOG.debug("Set focus: %d", focus)
+        await self.__exec(encode_focus_direct(focus))
 
     async def inq_focus(self) -> int:
-        answer = await self.__exec([0x81, 0x09, 0x04, 0x48, 0xFF], True)
+        answer = await self.__exec(INQ_FOCUS, True)
         check_answer([0x90, 0x50, None, None, None, None, 0xFF], answer)
         return convert_half_bytes_int(answer[2:6])
 
     async def inq_focus_af_mode(self) -> State:
-        result = await self.__exec([0x81, 0x09, 0x04, 0x38, 0xFF], True)
+        result = await self.__exec(INQ_FOCUS_AF_MODE, True)
         check_answer([0x90, 0x50, None, 0xFF], result)
         return State(result[2])
 
     async def inq_zoom(self) -> int:
-        answer = await self.__exec([0x81, 0x09, 0x04, 0x47, 0xFF], True)
+        answer = await self.__exec(INQ_ZOOM, True)
         check_answer([0x90, 0x50, None, None, None, None, 0xFF], answer)
         return convert_half_bytes_int(answer[2:6])
 
+    async def inq_pan_tilt(self) -> Tuple[int, int]:
+        answer = await self.__exec(INQ_PAN_TILT, True)
+        return parse_pan_tilt(answer)
+
+    async def inq_state(self) -> CameraState:
+        """Inquire pan/tilt, zoom, focus and AF mode at once, all within one round trip"""
+
+        pan_tilt, zoom, focus, af_mode = await self.__exec_pipelined(INQ_PAN_TILT, INQ_ZOOM, INQ_FOCUS,
+                                                                     INQ_FOCUS_AF_MODE, is_inq=True)
+        check_answer([0x90, 0x50, None, None, None, None, 0xFF], zoom)
+        check_answer([0x90, 0x50, None, None, None, None, 0xFF], focus)
+        check_answer([0x90, 0x50, None, 0xFF], af_mode)
+        return CameraState(*parse_pan_tilt(pan_tilt), convert_half_bytes_int(zoom[2:6]),
+                           convert_half_bytes_int(focus[2:6]), State(af_mode[2]))
+
     async def set_focus_lock(self, state: State):
-        LOG.debug(f"Set focus lock state: {state}")
+        LOG.debug("Set focus lock state: %s", state)
         # In case of a concurrent recall, clear the ephemeral AF flag, since FL overrides this semantically
         if state == State.ON:
             self.ephemeral_autofocus = False
         # Execute or unlock FL
-        await self.__exec([0x81, 0x0A, 0x04, 0x68, state.value, 0xFF])
+        await self.__exec(FOCUS_LOCK[state])
         if state == State.OFF:
             # When focus lock was turned off, instantly request autofocus to obtain a "sane" state
-            await self.__exec([0x81, 0x01, 0x04, 0x38, State.ON.value, 0xFF])
+            await self.__exec(AUTOFOCUS_ON)
 
     async def memory_set(self, pos: int):
-        LOG.debug(f"Save position {pos} to memory")
+        LOG.debug("Save position %d to memory", pos)
         if not 0 <= pos <= 127:
             raise Exception(f"Invalid position {pos}.")
-        await self.__exec([0x81, 0x01, 0x04, 0x3F, 0x01, pos, 0xFF])
+        await self.__exec(bytes([0x81, 0x01, 0x04, 0x3F, 0x01, pos, 0xFF]))
 
-    async def __memory_recall(self, pos: int):
-        """Internal function for recall execution"""
+    def compile_recall(self, pos: int, focus: int) -> RecallMacro:
+        """Get the compiled recall of a position, compiling it if new or if the focus value has changed"""
 
-        if not 0 <= pos <= 127:
-            raise Exception(f"Invalid position {pos}.")
-        await self.__exec([0x81, 0x01, 0x06, 0x01, VISCA_MEMORY_SPEED, 0xFF])
-        await self.__exec([0x81, 0x01, 0x04, 0x3F, 0x02, pos, 0xFF])
+        macro = self.recall_macros.get(pos)
+        if macro is None or macro.focus != focus:
+            macro = self.recall_macros[pos] = RecallMacro(pos, focus)
+        return macro
 
     async def recall(self, pos: int, focus: int):
-        """Perform a recall with a certain position and focus value."""
-
-        if self.recall_task is not None and not self.recall_task.done():
-            self.recall_task.cancel()
-            LOG.debug("Ongoing recall cancelled")
-
-        async def recall_wrapper(pos_int, focus_int):
-            LOG.debug(f"Executing recall of position {pos_int}...")
-            # If AF has been enabled ephemerally (by cancelled recall), we can continue right away
-            if not self.ephemeral_autofocus:
-                af_mode = await self.inq_focus_af_mode()
-                if af_mode == State.OFF:
-                    LOG.debug("Enabling ephemeral AF...")
-                    # Unlock focus ephemerally (activates AF) and set flag
-                    self.ephemeral_autofocus = True
-                    await self.set_focus_lock(State.OFF)
-            # Recall camera position from memory
-            await self.__memory_recall(pos_int)
-            # If AF has been enabled ephemerally before, perform FL and clear flag
-            if self.ephemeral_autofocus:
-                LOG.debug("Disabling ephemeral AF...")
-                await self.set_focus_lock(State.ON)
+        """Perform a recall with a certain position and focus value.
+
+        Each step waits for the completion of the commands it depends on, only independent commands are pipelined.
+        """
+
+        LOG.debug("Executing recall of position %d...", pos)
+        macro = self.compile_recall(pos, focus)
+        start = perf_counter()
+        # If AF has been enabled ephemerally (by cancelled recall), we can continue right away
+        if not self.ephemeral_autofocus and await self.inq_focus_af_mode() == State.OFF:
+            LOG.debug("Enabling ephemeral AF...")
+            # Unlock focus ephemerally and set flag, AF and memory speed are set once the focus is unlocked
+            self.ephemeral_autofocus = True
+            await self.__exec(FOCUS_LOCK[State.OFF])
+            await self.__exec_pipelined(AUTOFOCUS_ON, SET_MEMORY_SPEED)
+        else:
+            await self.__exec(SET_MEMORY_SPEED)
+        # Recall camera position from memory, at the speed set before, it completes once the camera has arrived
+        await self.__exec(macro.memory_recall, timeout=RECALL_TIMEOUT)
+        if self.ephemeral_autofocus:
+            # Perform FL and clear flag, the saved focus is applied once the focus is locked
+            LOG.debug("Disabling ephemeral AF...")
+            self.ephemeral_autofocus = False
+            await self.__exec(FOCUS_LOCK[State.ON])
+        if macro.focus_direct is not None:
             # Apply saved focus for position
-            await self.focus_direct(focus_int)
-
-        self.recall_task = asyncio.create_task(recall_wrapper(pos, focus))
+            await self.__exec(macro.focus_direct)
+        RECALL_SECONDS.observe(perf_counter() - start, self.ip)